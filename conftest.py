@@ -0,0 +1 @@
+# makes the repository root importable (polyrag) when the tests are run with a bare `pytest`
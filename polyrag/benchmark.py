@@ -0,0 +1,335 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import subprocess
+import contextlib
+import numpy as np
+from collections import Counter
+from polyrag.model.stub import StubLLM, StubEncoder
+from polyrag.util.tracing import tracer
+
+
+def summarize(latencies, items=None):
+    # latencies in seconds -> milliseconds percentiles, throughput in items (default: calls) per second
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total = latencies.sum()
+    items = len(latencies) if items is None else items
+    return {"count": len(latencies),
+            "mean_ms": float(latencies.mean() * 1000),
+            "p50_ms": float(np.percentile(latencies, 50) * 1000),
+            "p95_ms": float(np.percentile(latencies, 95) * 1000),
+            "p99_ms": float(np.percentile(latencies, 99) * 1000),
+            "throughput_per_s": float(items / total) if total > 0 else None}
+
+
+@contextlib.contextmanager
+def quiet():
+    # the pipeline and the tracker print query results and saves, keep them out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def measure(fn, inputs, warmup=1):
+    for x in inputs[:warmup]:
+        fn(x)
+    latencies = []
+    for x in inputs:
+        start = time.perf_counter()
+        fn(x)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def decode_steps(records, default_budget=256):
+    # decode steps of the llm.generate spans per stage, against the budgets they were given and against
+    # the fixed 256-token budget every stage used before the per-template budgets and stop conditions
+    stages = {}
+    for record in records:
+        for span in record.get("spans", []):
+            if span["name"] != "llm.generate":
+                continue
+            stage = stages.setdefault(span["parent"], {"calls": 0, "decode_steps": 0, "decode_budget": 0})
+            stage["calls"] += span.get("batch_size", 1)
+            stage["decode_steps"] += span.get("output_tokens") or 0
+            stage["decode_budget"] += span.get("decode_budget") or 0
+    for stage in stages.values():
+        stage["saved_vs_budget"] = stage["decode_budget"] - stage["decode_steps"]
+        stage["saved_vs_default"] = stage["calls"] * default_budget - stage["decode_steps"]
+    return stages
+
+
+# ------------------------------------------------------------------------------
+# workload: questions with canned S1 SPARQL built from staff names found in the ontology
+
+S1_TEMPLATES = [
+    ("What department does {name} work for?",
+     "SELECT ?department\nWHERE {{\n?staff base:has_name ?name .\nFILTER (contains(lcase(?name), lcase(\"{name}\")))\n"
+     "?staff base:works_for ?dept .\n?dept rdf:type base:DEPARTMENT .\n?dept rdfs:label ?department .\n}}"),
+    ("What is/are the research interests of {name}?",
+     "SELECT ?research_interest\nWHERE {{\n?staff base:has_name ?name .\nFILTER (contains(lcase(?name), lcase(\"{name}\")))\n"
+     "?staff base:has_research_interest ?research_interest .\n}}"),
+]
+
+
+def staff_names(onto, n, seed=0):
+    names = sorted({str(o) for o in onto.literal_index.literals.get(onto.namespace["has_name"], [])})
+    random.Random(seed).shuffle(names)
+    return names[:n]
+
+
+def make_workload(onto, n_questions, s1_share=0.4, s2_share=0.3, seed=0):
+    """
+    Returns (questions, stub LLM). About s1_share of the questions get a SPARQL query that the ontology
+    can answer, s2_share get a "Yes" agreement, the rest fall through to S3.
+    """
+    rng = random.Random(seed)
+    names = staff_names(onto, n_questions, seed)
+    questions, sparql, agreement = [], {}, {}
+    for i in range(n_questions):
+        name = names[i % len(names)] if names else f"Staff {i}"
+        question, query = S1_TEMPLATES[i % len(S1_TEMPLATES)]
+        question = question.format(name=name) + f" (#{i})"
+        roll = rng.random()
+        if roll < s1_share:
+            sparql[question] = "'''\n" + query.format(name=name.lower()) + "\n'''"
+        elif roll < s1_share + s2_share:
+            agreement[question] = "Yes"
+        questions.append(question)
+    return questions, StubLLM(sparql=sparql, agreement=agreement)
+
+
+def synthetic_triples(n, seed=0):
+    rng = np.random.default_rng(seed)
+    relations = ["works for", "has research interest", "graduated from", "has position", "published"]
+    return [{"sub": f"Staff {i % (n // 10 + 1)}", "rel": relations[i % len(relations)],
+             "obj": f"Topic {int(rng.integers(0, max(n // 4, 1)))}"} for i in range(n)]
+
+
+def write_search_data(directory, name, rows, encoder, stage):
+    from polyrag.util.embedding_search import data_labels
+    data_path = os.path.join(directory, f"{name}.json")
+    vector_path = os.path.join(directory, f"{name}_embed.npy")
+    json.dump(rows, open(data_path, "w"))
+    labels = data_labels(rows, stage)
+    np.save(vector_path, np.concatenate([encoder.encode(labels[i:i + 4096]) for i in range(0, len(labels), 4096)]))
+    return data_path, vector_path
+
+
+# ------------------------------------------------------------------------------
+# benchmarks, each returns a JSON-serializable dict
+
+def bench_cold_start(ontology_path):
+    results = {}
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import polyrag.model.PolyRAG"], check=True,
+                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    results["import_polyrag_s"] = time.perf_counter() - start
+    from polyrag.util.ontology_store import load_graph
+    _, _, results["ontology_turtle_s"] = load_graph(ontology_path, use_store=False)
+    _, source, seconds = load_graph(ontology_path)
+    results[f"ontology_{source}_s"] = seconds
+    return results
+
+
+def bench_s1(onto, queries, rdflib_queries=10):
+    # OntologyQuery.execute bypasses the result cache, so every call runs the query
+    results = {}
+    onto.use_fastpath = True
+    results["fastpath"] = summarize(measure(lambda q: onto.execute(q, max_result=10), queries))
+    onto.use_fastpath = False
+    results["rdflib"] = summarize(measure(lambda q: onto.execute(q, max_result=10), queries[:rdflib_queries]))
+    onto.use_fastpath = True
+    results["fastpath_hits"] = onto.fastpath.hits
+    results["fastpath_fallbacks"] = onto.fastpath.fallbacks
+    return results
+
+
+def few_shot_queries():
+    # the SPARQL of every S1 few-shot example, with the str.format escaping of the braces undone
+    from polyrag.util import templates
+    queries = []
+    for name in sorted(vars(templates)):
+        if name.startswith("S1_"):
+            text = getattr(templates, name).replace("{{", "{").replace("}}", "}")
+            queries.extend(q.strip() for q in re.findall(r"SPARQL: '''\n(.*?)'''", text, re.DOTALL))
+    return list(dict.fromkeys(queries))
+
+
+def check_fastpath(onto, queries):
+    """
+    Runs every query through the S1 fast path and through rdflib (graph.query) without a row limit,
+    and lists the queries whose rows differ. Rows are compared as multisets, neither side orders them.
+    """
+    from rdflib.plugins.sparql import prepareQuery
+    results = {"queries": len(queries), "fastpath": 0, "mismatches": []}
+    for query in queries:
+        rows = onto.fastpath.execute(query)
+        if rows is None:
+            continue
+        results["fastpath"] += 1
+        expected = [tuple(row) for row in onto.g.query(prepareQuery(query, initNs={"base": onto.namespace}))]
+        if Counter(rows) != Counter(expected):
+            results["mismatches"].append({"query": query, "fastpath_rows": len(rows), "rdflib_rows": len(expected)})
+    return results
+
+
+def bench_search(directory, sizes, n_queries, k, dim):
+    from polyrag.util.embedding_search import EmbeddingSearch
+    encoder = StubEncoder(dim)
+    results = {}
+    for size in sizes:
+        rows = synthetic_triples(size)
+        data_path, vector_path = write_search_data(directory, f"synthetic_{size}", rows, encoder, stage=2)
+        queries = [f"Staff {i} has research interest" for i in range(n_queries)]
+        size_results = {}
+        for mode in ("dense", "sparse", "hybrid", "shortlist"):
+            es = EmbeddingSearch(vector_path, data_path, stage=2, model=encoder, encoder_id="stub", retrieval=mode,
+                                 exact=True)
+            size_results[mode] = summarize(measure(lambda q: es.search_top_k(q, k=k), queries))
+            if mode == "dense":
+                size_results["dense_batch"] = summarize(
+                    measure(lambda qs: es.search_top_k_batch(qs, k=k), [queries[i:i + 32] for i in range(0, n_queries, 32)]),
+                    items=n_queries)
+                start = time.perf_counter()
+                es.build_index(save=False)
+                size_results["ivf_build_s"] = time.perf_counter() - start
+                es.exact = False
+                size_results["dense_ivf"] = summarize(measure(lambda q: es.search_top_k(q, k=k), queries))
+        results[str(size)] = size_results
+    return results
+
+
+def bench_tracker(directory, n_records):
+    from polyrag.util.retrieval_tracker import RetrievalTracker
+    results = {}
+    for ext in ("jsonl", "json"):
+        tracker = RetrievalTracker(os.path.join(directory, f"tracker_bench.{ext}"), flush_every=32)
+        records = [(f"Question {i}?", None, [f"context {i}"], i % 2 == 0, [f"chunk {i}"]) for i in range(n_records)]
+        with quiet():
+            results[ext] = summarize(measure(lambda r: tracker.update_tracker(*r, save=True), records, warmup=0))
+            if tracker.jsonl:
+                tracker.flush()
+    return results
+
+
+def bench_pipeline(directory, config, questions, llm, encoder, batch_sizes):
+    from polyrag.model.PolyRAG import PolyRAG
+    results = {}
+    config = dict(config, tracker_dir=directory, tracker_format="jsonl", tracker_flush_every=1024)
+    start = time.perf_counter()
+    poly = PolyRAG(config, encoder=encoder)
+    poly.warmup()
+    results["warmup_s"] = time.perf_counter() - start
+    results["startup_report"] = poly.startup_report
+    tracer.metrics.clear()
+    with quiet():
+        # fresh caches so the single and batched runs see the same work
+        poly.onto.cache.clear()
+        results["run_llm"] = summarize(measure(lambda q: poly.run_llm(llm, q), questions, warmup=0))
+        records = poly.tracker.tracker[-len(questions):]
+        results["success_rounds"] = {str(r): sum(t["success_round"] == r for t in records) for r in (1, 2, 3)}
+        results["decode_steps"] = decode_steps(records)
+        for batch_size in batch_sizes:
+            poly.onto.cache.clear()
+            poly.query_cache.clear()
+            batches = [questions[i:i + batch_size] for i in range(0, len(questions), batch_size)]
+            results[f"run_batch_{batch_size}"] = summarize(measure(lambda b: poly.run_batch(llm, b), batches, warmup=0),
+                                                           items=len(questions))
+        poly.tracker.flush()
+    results["llm_calls"] = llm.calls
+    # time per stage and sub-step over all the runs above
+    results["spans"] = tracer.metrics.to_dict()
+    return results
+
+
+def compare(results, baseline, path="", threshold=1.2):
+    # p50 latencies that got slower than `threshold` times the baseline
+    regressions = []
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        if isinstance(value, dict):
+            regressions.extend(compare(value, baseline[key], f"{path}{key}.", threshold))
+        elif key == "p50_ms" and baseline[key] and value > threshold * baseline[key]:
+            regressions.append((path + key, baseline[key], value))
+    return regressions
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the PolyRAG stages with a stub LLM and synthetic embeddings")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--ontology_path", default="data/polyu_onto.ttl")
+    parser.add_argument("--kg_path", default="data/poly_kg.json")
+    parser.add_argument("--benchmarks", default="cold_start,fastpath,s1,search,tracker,pipeline")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--sizes", default="10000,100000", help="synthetic corpus sizes for the search benchmark")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--batch_sizes", default="8,32")
+    parser.add_argument("--tracker_records", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", default=None, help="earlier output to compare p50 latencies against")
+    args = parser.parse_args()
+
+    benchmarks = args.benchmarks.split(",")
+    config = json.load(open(args.config, "r"))
+    config["ontology_path"] = args.ontology_path
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="polyrag-bench-") as directory:
+        if "cold_start" in benchmarks:
+            results["cold_start"] = bench_cold_start(args.ontology_path)
+        if "fastpath" in benchmarks or "s1" in benchmarks or "pipeline" in benchmarks:
+            from polyrag.util.ontology_query import OntologyQuery
+            onto = OntologyQuery(args.ontology_path)
+            questions, llm = make_workload(onto, args.questions, seed=args.seed)
+        if "fastpath" in benchmarks:
+            # the fast path must return exactly what rdflib returns, on the few-shot and the workload queries
+            queries = [onto.get_clean_query(output) for output in llm.sparql.values()]
+            results["fastpath"] = check_fastpath(onto, few_shot_queries() + queries)
+        if "s1" in benchmarks:
+            queries = [onto.get_clean_query(output) for output in llm.sparql.values()]
+            results["s1"] = bench_s1(onto, queries)
+        if "search" in benchmarks:
+            results["search"] = bench_search(directory, [int(s) for s in args.sizes.split(",")], args.queries, 10, args.dim)
+        if "tracker" in benchmarks:
+            results["tracker"] = bench_tracker(directory, args.tracker_records)
+        if "pipeline" in benchmarks:
+            encoder = StubEncoder(args.dim)
+            kg = json.load(open(args.kg_path, "r"))
+            kg_path, kg_embed_path = write_search_data(directory, "kg", kg, encoder, stage=2)
+            # the corpus is made of chunks of consecutive KG labels
+            chunks = [{"text": ". ".join(f"{x['sub']} {x['rel']} {x['obj']}" for x in kg[i:i + 8])}
+                      for i in range(0, len(kg), 8)]
+            rag_path, rag_embed_path = write_search_data(directory, "corpus", chunks, encoder, stage=3)
+            config.update(kg_path=kg_path, kg_embed_path=kg_embed_path, rag_path=rag_path, rag_embed_path=rag_embed_path,
+                          poly="s1s2s3", speculative=False)
+            results["pipeline"] = bench_pipeline(directory, config, questions, llm, encoder,
+                                                 [int(b) for b in args.batch_sizes.split(",")])
+
+    output = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()), "python": platform.python_version(),
+                       "numpy": np.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                       "args": vars(args)},
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=4)
+    print(json.dumps(results, indent=4))
+    print(f"Benchmark results saved to {args.output}")
+    if args.baseline:
+        regressions = compare(results, json.load(open(args.baseline, "r"))["results"])
+        for key, before, after in regressions:
+            print(f"[Regression] {key}: {before:.2f}ms -> {after:.2f}ms")
+        if not regressions:
+            print("No p50 regression against the baseline")
+    if results.get("fastpath", {}).get("mismatches"):
+        for mismatch in results["fastpath"]["mismatches"]:
+            print(f"[Fast path mismatch] {mismatch['fastpath_rows']} rows vs {mismatch['rdflib_rows']} from rdflib:\n{mismatch['query']}")
+        sys.exit(1)
@@ -1,28 +1,170 @@
 import json
 import os
-from polyrag.model.llm import Llama3
-from polyrag.util.ontology_query import OntologyQuery
+import time
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from polyrag.util.retrieval_tracker import RetrievalTracker
-from polyrag.util.embedding_search import EmbeddingSearch
+from polyrag.util.embedding_cache import QueryEmbeddingCache, encoder_identity
+from polyrag.util.tracing import tracer
+from polyrag.model.stopping import StopCondition
 import polyrag.util.templates as tp
 
+
+def static_prefix(template):
+    # the literal text of a template before its first placeholder, identical for every question
+    prefix = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        prefix.append(literal)
+        if field is not None:
+            break
+    return ''.join(prefix)
+
+
 class PolyRAG:
-    def __init__(self, config):
+    def __init__(self, config, encoder=None, encoder_id=None):
+        # `encoder` is an already loaded sentence encoder (e.g. polyrag.model.stub.StubEncoder) used
+        # instead of loading config['embed_model_dir']; `encoder_id` names it in the query-embedding cache
+        # and is derived from the encoder (see encoder_identity) when not given
         self.config = config
 
         self.poly = config['poly']
         self.model_name = config['model_name']
         self.tracker_dir = config['tracker_dir']
-        self.tracker_file = f"tracker_{self.model_name}_{self.poly}.json"
+        # "jsonl" trackers are append-only with buffered writes, "json" rewrites the whole file on save
+        self.tracker_format = config.get('tracker_format', 'jsonl')
+        self.tracker_file = f"tracker_{self.model_name}_{self.poly}.{self.tracker_format}"
         self.tracker_path = os.path.join(self.tracker_dir, self.tracker_file)
-        self.tracker = RetrievalTracker(self.tracker_path)
+        # seconds spent building each component, see print_startup_report
+        self.startup_report = {}
+        start = time.time()
+        self.tracker = RetrievalTracker(self.tracker_path, flush_every=config.get('tracker_flush_every', 32),
+                                        flush_interval=config.get('tracker_flush_interval', 5.0))
+        self.startup_report["tracker"] = time.time() - start
 
+        # the ontology, the searches and the encoder are built on first use (see warmup), so a worker only
+        # pays for the stages it runs and importing this module does not pull in rdflib or torch
         self.ontology_path = config['ontology_path']
-        self.onto = OntologyQuery(self.ontology_path)
         self.s2k = config['s2k']
-        self.kg_es = EmbeddingSearch(config['kg_embed_path'], config['kg_path'], stage=2)
         self.s3k = config['s3k']
-        self.rag_es = EmbeddingSearch(config['rag_embed_path'], config['rag_path'], stage=3)
+        self._onto = None
+        self._kg_es = None
+        self._rag_es = None
+        self._encoder = (encoder, encoder_id or encoder_identity(encoder)) if encoder is not None else None
+        self._query_cache = None
+        self._load_lock = threading.RLock()
+
+        # few-shot prefixes whose KV-cache the model can prefill once and reuse
+        self.s1_prefix = static_prefix(tp.S1_QUERY_V2_4_SHOTS)
+        self.s2_prefix = static_prefix(tp.S2_AGREEMENT_2_SHOTS)
+        # s2_scoring "logits" answers the S2 agreement check from one forward pass (P(Yes) >= s2_threshold)
+        # instead of generating a response, for models that have score_yes_no
+        self.s2_scoring = config.get('s2_scoring', 'generate')
+        self.s2_threshold = config.get('s2_threshold', 0.5)
+        # decode budgets per template, S1 also stops once its query is closed (get_clean_query keeps
+        # nothing past the first "}" after SELECT)
+        self.s1_max_new_tokens = config.get('s1_max_new_tokens', 128)
+        self.s2_max_new_tokens = config.get('s2_max_new_tokens', 16)
+        self.answer_max_new_tokens = config.get('answer_max_new_tokens', 256)
+        self.s1_stop = StopCondition.from_config(config.get('s1_stop', {"strings": ["'''"], "balanced_braces": True,
+                                                                        "start": "SELECT"}))
+
+        # speculative mode runs the S2/S3 searches in a thread pool while S1 is generating
+        self.speculative = config.get('speculative', False)
+        self._executor = None
+        self._speculation_lock = threading.Lock()
+        self.speculation_stats = {"submitted": 0, "used": 0, "cancelled": 0, "wasted": 0, "wasted_seconds": 0.0}
+
+    def _load(self, name, build):
+        start = time.time()
+        component = build()
+        self.startup_report[name] = time.time() - start
+        return component
+
+    @property
+    def onto(self):
+        if self._onto is None:
+            with self._load_lock:
+                if self._onto is None:
+                    self._onto = self._load("ontology", self._build_onto)
+        return self._onto
+
+    def _build_onto(self):
+        from polyrag.util.ontology_query import OntologyQuery
+        config = self.config
+        return OntologyQuery(self.ontology_path, cache_size=config.get('sparql_cache_size', 1024),
+                             cache_ttl=config.get('sparql_cache_ttl', 3600), timeout=config.get('sparql_timeout', 5.0))
+
+    @property
+    def query_cache(self):
+        # both stages share one query-embedding cache
+        if self._query_cache is None:
+            with self._load_lock:
+                if self._query_cache is None:
+                    self._query_cache = QueryEmbeddingCache(max_size=self.config.get('query_cache_size', 4096),
+                                                            cache_path=self.config.get('query_cache_path'))
+        return self._query_cache
+
+    def _build_search(self, vector_path, data_path, stage, retrieval, n_probe):
+        from polyrag.util.embedding_search import EmbeddingSearch
+        # s2_retrieval/s3_retrieval: "dense", "sparse" (BM25, no encoder), "hybrid" or "shortlist";
+        # s2_n_probe/s3_n_probe trade recall for latency on an IVF index, exact_search ignores the index
+        es = EmbeddingSearch(vector_path, data_path, stage=stage, cache=self.query_cache, retrieval=retrieval,
+                             n_probe=n_probe, exact=self.config.get('exact_search', False))
+        # the encoder is only loaded when a stage scores densely, and is shared by both stages
+        if es.needs_encoder:
+            if self._encoder is None:
+                start = time.time()
+                es.load_embedding_model(self.config['embed_model_dir'])
+                self._encoder = (es.model, es.encoder_id)
+                self.startup_report["encoder"] = time.time() - start
+            else:
+                es.model, es.encoder_id = self._encoder
+        return es
+
+    @property
+    def kg_es(self):
+        if self._kg_es is None:
+            with self._load_lock:
+                if self._kg_es is None:
+                    self._kg_es = self._load("kg_search", lambda: self._build_search(
+                        self.config['kg_embed_path'], self.config['kg_path'], 2, self.config.get('s2_retrieval', 'dense'),
+                        self.config.get('s2_n_probe')))
+        return self._kg_es
+
+    @property
+    def rag_es(self):
+        if self._rag_es is None:
+            with self._load_lock:
+                if self._rag_es is None:
+                    self._rag_es = self._load("rag_search", lambda: self._build_search(
+                        self.config['rag_embed_path'], self.config['rag_path'], 3, self.config.get('s3_retrieval', 'dense'),
+                        self.config.get('s3_n_probe')))
+        return self._rag_es
+
+    def warmup(self):
+        # build the components of the stages listed in `poly` now instead of on the first question
+        if "s1" in self.poly:
+            self.onto
+        if "s2" in self.poly:
+            self.kg_es
+        if "s3" in self.poly:
+            self.rag_es
+        return self.startup_report
+
+    def close(self):
+        # persist the query-embedding cache (query_cache_path) and flush the tracker, e.g. on service shutdown
+        if self._query_cache is not None and self._query_cache.cache_path:
+            self._query_cache.save()
+        self.tracker.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def print_startup_report(self):
+        # a search's time includes loading the encoder when it was the first stage to need it
+        for name, seconds in self.startup_report.items():
+            print(f"[Startup] {name}: {seconds:.2f}s")
 
     def _s1_sparql_prompt(self, question):
         template = tp.S1_QUERY_V2_4_SHOTS
@@ -35,51 +177,144 @@ class PolyRAG:
     
     def _s2_kg_agreement_prompt(self, question):
         self.kg_context = self.kg_es.search_top_k(question, k=self.s2k)
+        return self._s2_agreement_prompt(question, self.kg_context)
+
+    def _s2_agreement_prompt(self, question, kg_context):
         template = tp.S2_AGREEMENT_2_SHOTS
-        prompt = template.format(question=question, information=['\n'.join(self.kg_context)])
+        prompt = template.format(question=question, information=['\n'.join(kg_context)])
         return prompt
     
     def _s2_agreement_result(self, output):
         return True if "Yes" in output else False
+
+    def _scores_s2(self):
+        return self.s2_scoring == "logits" and hasattr(self.llm, "score_yes_no")
+
+    def _score_batch(self, prompts, **kwargs):
+        if hasattr(self.llm, "score_yes_no_batch"):
+            return self.llm.score_yes_no_batch(prompts, **kwargs)
+        return [self.llm.score_yes_no(prompt, **kwargs) for prompt in prompts]
     
     def _s3_rag_context(self, question):
         self.rag_context = self.rag_es.search_top_k(question, k=self.s3k)
         return self.rag_context
     
-    def run_llm(self, model, question, print=False):
+    def _speculate(self, fn, *args, **kwargs):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="polyrag-speculative")
+
+        # spans of the speculative search are recorded in the trace of the question that started it
+        trace = tracer.current
+
+        def timed():
+            start = time.time()
+            with tracer.attach(trace), tracer.span("speculative"):
+                result = fn(*args, **kwargs)
+            return result, time.time() - start
+
+        with self._speculation_lock:
+            self.speculation_stats["submitted"] += 1
+        return self._executor.submit(timed)
+
+    def _collect(self, future):
+        result, _ = future.result()
+        with self._speculation_lock:
+            self.speculation_stats["used"] += 1
+        return result
+
+    def _drop(self, *futures):
+        # cancel speculative work that an earlier stage made unnecessary, or account for it as wasted
+        for future in futures:
+            if future is None:
+                continue
+            if future.cancel():
+                with self._speculation_lock:
+                    self.speculation_stats["cancelled"] += 1
+            else:
+                future.add_done_callback(self._record_wasted)
+
+    def _record_wasted(self, future):
+        with self._speculation_lock:
+            self.speculation_stats["wasted"] += 1
+            if future.exception() is None:
+                self.speculation_stats["wasted_seconds"] += future.result()[1]
+
+    def run_llm(self, model, question, print_result=False, speculative=None):
 
         self.llm = model
+        speculative = self.speculative if speculative is None else speculative
+        s1_output = None
         s1_result = None
         s2_result = None
         s3_context = None
+        s2_score = None
         self.kg_context = None
 
-        if "s1" in self.poly:
-            s1_prompt = self._s1_sparql_prompt(question)
-            s1_output, s1_query = self.llm.generate(s1_prompt)
-            s1_result = self._s1_query_result(s1_output)
-            if print:
-                print("====== S1 SECTION ======") 
-                print("S1 Prompt:", s1_query)
-                print("S1 Output:", s1_output)
+        # every stage and sub-step is a span of this question's trace, the spans are kept in its tracker record
+        with tracer.trace("run_llm") as trace:
+            # the S2/S3 searches only depend on the question, start them before S1 generates
+            s2_future = None
+            s3_future = None
+            if speculative:
+                if "s2" in self.poly:
+                    s2_future = self._speculate(self.kg_es.search_top_k, question, k=self.s2k)
+                if "s3" in self.poly:
+                    s3_future = self._speculate(self.rag_es.search_top_k, question, k=self.s3k)
 
-        if "s2" in self.poly:
-            s2_prompt = self._s2_kg_agreement_prompt(question)
-            s2_output, s2_query = self.llm.generate(s2_prompt)
-            s2_result = self._s2_agreement_result(s2_output)
-            if print:
-                print("====== S2 SECTION ======") 
-                print("S2 Prompt:", s2_query)
-                print("S2 Context:", self.kg_context)
-                print("S2 Output:", s2_output)
-                print("S2 Agreement:", s2_result)
+            if "s1" in self.poly:
+                with tracer.span("s1"):
+                    with tracer.span("s1.prompt"):
+                        s1_prompt = self._s1_sparql_prompt(question)
+                    s1_output, s1_query = self.llm.generate(s1_prompt, prefix=self.s1_prefix, stop=self.s1_stop,
+                                                            max_new_tokens=self.s1_max_new_tokens)
+                    s1_result = self._s1_query_result(s1_output)
+                if print_result:
+                    print("====== S1 SECTION ======") 
+                    print("S1 Prompt:", s1_query)
+                    print("S1 Output:", s1_output)
 
-        if "s3" in self.poly:
-            s3_context = self._s3_rag_context(question)
+            # in speculative mode the waterfall stops at the first successful stage
+            if speculative and s1_result:
+                self._drop(s2_future, s3_future)
+                s3_future = None
+            elif "s2" in self.poly:
+                with tracer.span("s2"):
+                    if s2_future is not None:
+                        self.kg_context = self._collect(s2_future)
+                        with tracer.span("s2.prompt"):
+                            s2_prompt = self._s2_agreement_prompt(question, self.kg_context)
+                    else:
+                        with tracer.span("s2.prompt"):
+                            s2_prompt = self._s2_kg_agreement_prompt(question)
+                    if self._scores_s2():
+                        s2_score = self.llm.score_yes_no(s2_prompt, prefix=self.s2_prefix)
+                        s2_output, s2_query = f"P(Yes) = {s2_score:.3f}", s2_prompt
+                        s2_result = s2_score >= self.s2_threshold
+                    else:
+                        s2_output, s2_query = self.llm.generate(s2_prompt, prefix=self.s2_prefix,
+                                                                max_new_tokens=self.s2_max_new_tokens)
+                        s2_result = self._s2_agreement_result(s2_output)
+                if print_result:
+                    print("====== S2 SECTION ======") 
+                    print("S2 Prompt:", s2_query)
+                    print("S2 Context:", self.kg_context)
+                    print("S2 Output:", s2_output)
+                    print("S2 Agreement:", s2_result)
+
+            if speculative and (s1_result or s2_result):
+                self._drop(s3_future)
+            elif "s3" in self.poly:
+                with tracer.span("s3"):
+                    if s3_future is not None:
+                        s3_context = self._collect(s3_future)
+                        self.rag_context = s3_context
+                    else:
+                        s3_context = self._s3_rag_context(question)
 
-        self.tracker.update_tracker(question, s1_result, self.kg_context, s2_result, s3_context, save=True)
+            self.tracker.update_tracker(question, s1_result, self.kg_context, s2_result, s3_context, save=True,
+                                        spans=trace.spans, s2_agreement_score=s2_score)
 
-        if print:
+        if print_result:
             print("====== POLYRAG SUMMARY ======")
             print(f"Question: {question}")
             print(f"S1 SPARQL Query: {s1_output}")
@@ -90,8 +325,85 @@ class PolyRAG:
 
         return self.tracker
     
+    def _generate_batch(self, prompts, **kwargs):
+        # models without batched generation fall back to one generate call per prompt
+        if hasattr(self.llm, "generate_batch"):
+            return self.llm.generate_batch(prompts, **kwargs)
+        return [self.llm.generate(prompt, **kwargs) for prompt in prompts]
+
+    def run_batch(self, model, questions, ids=None, print_result=False):
+        # waterfall over many questions: each stage only sees the questions the previous stages did not resolve
+        self.llm = model
+        n = len(questions)
+        s1_results = [None] * n
+        s2_contexts = [None] * n
+        s2_results = [None] * n
+        s3_contexts = [None] * n
+        s2_scores = [None] * n
+        pending = list(range(n))
+
+        # one trace per batch, its spans are attached to every record of the batch
+        with tracer.trace("run_batch") as trace:
+            if "s1" in self.poly and pending:
+                with tracer.span("s1", questions=len(pending)):
+                    with tracer.span("s1.prompt"):
+                        s1_prompts = [self._s1_sparql_prompt(questions[i]) for i in pending]
+                    s1_outputs = [output for output, _ in self._generate_batch(s1_prompts, prefix=self.s1_prefix, stop=self.s1_stop,
+                                                                                max_new_tokens=self.s1_max_new_tokens)]
+                    for i, result in zip(pending, self.onto.get_query_results(s1_outputs, max_result=10)):
+                        s1_results[i] = result
+                pending = [i for i in pending if not s1_results[i]]
+                if print_result:
+                    print(f"[S1] {n - len(pending)}/{n} questions answered by the ontology")
+
+            if "s2" in self.poly and pending:
+                with tracer.span("s2", questions=len(pending)):
+                    kg_contexts = self.kg_es.search_top_k_batch([questions[i] for i in pending], k=self.s2k)
+                    with tracer.span("s2.prompt"):
+                        s2_prompts = [self._s2_agreement_prompt(questions[i], c) for i, c in zip(pending, kg_contexts)]
+                    if self._scores_s2():
+                        for i, context, score in zip(pending, kg_contexts, self._score_batch(s2_prompts, prefix=self.s2_prefix)):
+                            s2_contexts[i] = context
+                            s2_scores[i] = score
+                            s2_results[i] = score >= self.s2_threshold
+                    else:
+                        s2_outputs = [output for output, _ in self._generate_batch(s2_prompts, prefix=self.s2_prefix,
+                                                                                    max_new_tokens=self.s2_max_new_tokens)]
+                        for i, context, output in zip(pending, kg_contexts, s2_outputs):
+                            s2_contexts[i] = context
+                            s2_results[i] = self._s2_agreement_result(output)
+                if print_result:
+                    print(f"[S2] {sum(s2_results[i] for i in pending)}/{len(pending)} questions answered by the KG")
+                pending = [i for i in pending if not s2_results[i]]
+
+            if "s3" in self.poly and pending:
+                with tracer.span("s3", questions=len(pending)):
+                    rag_contexts = self.rag_es.search_top_k_batch([questions[i] for i in pending], k=self.s3k)
+                    for i, context in zip(pending, rag_contexts):
+                        s3_contexts[i] = context
+                if print_result:
+                    print(f"[S3] {len(pending)}/{n} questions fall back to RAG")
+
+            self.tracker.update_tracker_batch(questions, s1_results, s2_contexts, s2_results, s3_contexts, ids=ids,
+                                              save=True, spans=trace.spans, s2_agreement_scores=s2_scores)
+        return self.tracker
+
     def get_current_context(self):
-        return self.tracker[-1]['context']
+        return self.tracker.tracker[-1]['context']
+
+    def final_answer_prompt(self, question, context=None):
+        context = self.get_current_context() if context is None else context
+        return tp.FINAL_ANSWER.format(context=context, question=question)
+
+    def stream_answer(self, model, question, context=None, **kwargs):
+        # yields the final answer as text deltas, models without generate_stream yield it in one piece
+        prompt = self.final_answer_prompt(question, context)
+        kwargs.setdefault("max_new_tokens", self.answer_max_new_tokens)
+        with tracer.span("answer"):
+            if hasattr(model, "generate_stream"):
+                yield from model.generate_stream(prompt, **kwargs)
+            else:
+                yield model.generate(prompt, **kwargs)[0]
     
 
 # ------------------------------------------------------------------------------
@@ -104,8 +416,9 @@ if __name__ == "__main__":
 
     
     if config['model_name'] == "llama3":
+        from polyrag.model.llm import Llama3
         model = Llama3(config['model_dir'])
-        tracker = poly.run_llm(model, q, print=True)
+        tracker = poly.run_llm(model, q, print_result=True)
         context = poly.get_current_context()
     else:
         raise ValueError("Model not supported")
\ No newline at end of file
@@ -1,13 +1,80 @@
+import copy
+import time
+import threading
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from collections import OrderedDict
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from polyrag.model.stopping import StopCondition
+from polyrag.util.tracing import tracer
+
+
+class PrefixCache:
+    # LRU cache of prefilled past_key_values for static prompt prefixes, bounded by memory
+    def __init__(self, max_bytes=2 * 1024**3):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return self._cache[key][:2]
+        self.misses += 1
+        return None
+
+    def put(self, key, input_ids, past_key_values, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        if key in self._cache:
+            self.nbytes -= self._cache.pop(key)[2]
+        self._cache[key] = (input_ids, past_key_values, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self._cache.popitem(last=False)[1][2]
+
+    def stats(self):
+        return {"size": len(self._cache), "nbytes": self.nbytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+
+class TextStop(StoppingCriteria):
+    # stops each row once `stop(generated_text)` is true (see StopCondition), generate pads the finished
+    # rows of a batch while the others keep decoding, a finished row is not decoded again
+    def __init__(self, tokenizer, prompt_len, stop):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.stop = stop
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for i in (~self.done).nonzero().flatten().tolist():
+            if self.stop(self.tokenizer.decode(input_ids[i, self.prompt_len:], skip_special_tokens=True)):
+                self.done[i] = True
+        return self.done.clone()
+
 
 class Llama3:
-    def __init__(self,model_dir) -> None:
+    # appended to get_prompt so the next token is the first token of the answer
+    ASSISTANT_HEADER = '<|start_header_id|>assistant<|end_header_id|>\n\n'
+
+    def __init__(self,model_dir, prefix_cache_bytes=2 * 1024**3) -> None:
         self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
         eot = "<|eot_id|>"
         eot_id = self.tokenizer.convert_tokens_to_ids(eot)
         self.tokenizer.pad_token = eot
         self.tokenizer.pad_token_id = eot_id
+        # batched generation needs the prompts aligned on the right
+        self.tokenizer.padding_side = "left"
+        # fast tokenizers are not safe to call from two threads at once (padding state is set per call),
+        # the service streams answers while the next batch is being retrieved
+        self._tokenizer_lock = threading.Lock()
 
         self.model = AutoModelForCausalLM.from_pretrained(
             model_dir,
@@ -16,6 +83,17 @@ class Llama3:
         )
         self.model.config.eos_token = eot
         self.model.config.eos_token_id = eot_id
+        self.prefix_cache = PrefixCache(max_bytes=prefix_cache_bytes)
+        # first token of each way the answer can start, see score_yes_no
+        self.yes_ids = self._first_token_ids(["Yes", " Yes", "yes"])
+        self.no_ids = self._first_token_ids(["No", " No", "no"])
+
+    def _encode(self, *args, **kwargs):
+        with self._tokenizer_lock:
+            return self.tokenizer(*args, **kwargs)
+
+    def _first_token_ids(self, words):
+        return sorted({self._encode(w, add_special_tokens=False)['input_ids'][0] for w in words})
     
     def get_prompt(self, message: str, chat_history: list[tuple[str, str]],
                system_prompt: str) -> str:
@@ -39,13 +117,242 @@ class Llama3:
         texts.append(f'{message}<|eot_id|>')
         return ''.join(texts)
 
-    def generate(self, text, temperature=0.7, system="You are a chatbot who gives helpful, detailed, and precise answers to the user's questions.", top_p=0.8, max_new_tokens=256):
-        query = self.get_prompt(text, [], system)
+    def _kv_nbytes(self, seq_len):
+        config = self.model.config
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        return 2 * config.num_hidden_layers * kv_heads * head_dim * seq_len * self.model.dtype.itemsize
+
+    def get_prefix_cache(self, prefix, system):
+        # `prefix` is the static leading part of a user message (e.g. a few-shot template up to its first
+        # placeholder). The system header is part of the cached prefix, it is cut at the last newline so
+        # the tokenization of the prefix does not depend on the text that follows it.
+        query_prefix = self.get_prompt(prefix, [], system)[:-len('<|eot_id|>')]
+        query_prefix = query_prefix[:query_prefix.rfind('\n') + 1]
+        cached = self.prefix_cache.get(query_prefix)
+        if cached is None:
+            input_ids = self._encode(query_prefix, return_tensors="pt", add_special_tokens=False)['input_ids'].to(self.model.device)
+            with torch.no_grad():
+                past_key_values = self.model(input_ids=input_ids, use_cache=True).past_key_values
+            self.prefix_cache.put(query_prefix, input_ids, past_key_values, self._kv_nbytes(input_ids.size(-1)))
+            cached = (input_ids, past_key_values)
+        return cached
+
+    def _reuse_prefix(self, inputs, prefix, system):
+        prefix_ids, past_key_values = self.get_prefix_cache(prefix, system)
+        input_ids = inputs['input_ids']
+        n = min(prefix_ids.size(-1), input_ids.size(-1) - 1)
+        # only the tokens shared with the prompt can be reused, generate prefills the rest
+        same = (prefix_ids[0, :n] == input_ids[0, :n]).int()
+        n = int(same.cumprod(0).sum())
+        if n == 0:
+            return None
+        past_key_values = copy.deepcopy(past_key_values)
+        if n < prefix_ids.size(-1):
+            # a negative crop removes that many tokens from the end, crop(length) is deprecated
+            past_key_values.crop(n - prefix_ids.size(-1))
+        return past_key_values
 
-        inputs = self.tokenizer(query, return_tensors="pt", add_special_tokens=False,return_token_type_ids=False)
+    def _prepare_batch_inputs(self, queries, prefix=None, system=None):
+        # left-padded batch; with a prefix, the cached prefix KV is shared by every row and each row's rest of the
+        # prompt is padded in the middle (prefix, pads, rest), generate derives the positions from the mask
+        inputs = None
+        if prefix is not None:
+            with tracer.span("llm.prefix_cache") as span:
+                hits = self.prefix_cache.hits
+                inputs = self._reuse_prefix_batch(queries, prefix, system)
+                span["cache_hit"] = self.prefix_cache.hits > hits
+        if inputs is None:
+            inputs = self._encode(queries, return_tensors="pt", padding=True, add_special_tokens=False, return_token_type_ids=False)
         for k in inputs:
-            inputs[k] = inputs[k].cuda()
+            if k != 'past_key_values':
+                inputs[k] = inputs[k].to(self.model.device)
+        return inputs
+
+    def _reuse_prefix_batch(self, queries, prefix, system):
+        prefix_ids, past_key_values = self.get_prefix_cache(prefix, system)
+        rows = self._encode(queries, add_special_tokens=False)['input_ids']
+        prefix_ids = prefix_ids[0].tolist()
+        n = min(len(prefix_ids), *(len(ids) - 1 for ids in rows))
+        for ids in rows:
+            while n > 0 and ids[:n] != prefix_ids[:n]:
+                n -= 1
+        if n == 0:
+            return None
+        width = max(len(ids) for ids in rows) - n
+        pad = self.tokenizer.pad_token_id
+        input_ids = [ids[:n] + [pad] * (width - len(ids) + n) + ids[n:] for ids in rows]
+        attention_mask = [[1] * n + [0] * (width - len(ids) + n) + [1] * (len(ids) - n) for ids in rows]
+        past_key_values = copy.deepcopy(past_key_values)
+        if n < len(prefix_ids):
+            past_key_values.crop(n - len(prefix_ids))
+        past_key_values.batch_repeat_interleave(len(rows))
+        return {'input_ids': torch.tensor(input_ids), 'attention_mask': torch.tensor(attention_mask),
+                'past_key_values': past_key_values}
+
+    def _prepare_inputs(self, text, system, prefix=None, suffix=""):
+        query = self.get_prompt(text, [], system) + suffix
+
+        with tracer.span("llm.tokenize"):
+            inputs = self._encode(query, return_tensors="pt", add_special_tokens=False,return_token_type_ids=False)
+            for k in inputs:
+                inputs[k] = inputs[k].to(self.model.device)
+
+        if prefix is not None:
+            with tracer.span("llm.prefix_cache") as span:
+                hits = self.prefix_cache.hits
+                past_key_values = self._reuse_prefix(inputs, prefix, system)
+                span["cache_hit"] = self.prefix_cache.hits > hits
+            if past_key_values is not None:
+                inputs['past_key_values'] = past_key_values
+        return inputs, query
 
-        outputs = self.model.generate(**inputs, do_sample=True, temperature=temperature, top_p=top_p, max_length=max_new_tokens + inputs['input_ids'].size(-1))
+    def _stopping_criteria(self, inputs, stop):
+        # `stop` is a predicate on the generated text (e.g. a StopCondition) or a list of stop strings
+        if not stop:
+            return None
+        if not callable(stop):
+            stop = StopCondition(stop)
+        return StoppingCriteriaList([TextStop(self.tokenizer, inputs['input_ids'].size(-1), stop)])
+
+    def generate(self, text, temperature=0.7, system="You are a chatbot who gives helpful, detailed, and precise answers to the user's questions.", top_p=0.8, max_new_tokens=256,
+                 prefix=None, stop=None):
+        inputs, query = self._prepare_inputs(text, system, prefix)
+
+        with tracer.span("llm.generate") as span:
+            outputs = self.model.generate(**inputs, do_sample=True, temperature=temperature, top_p=top_p, max_length=max_new_tokens + inputs['input_ids'].size(-1),
+                                          stopping_criteria=self._stopping_criteria(inputs, stop))
+            span["prompt_tokens"] = inputs['input_ids'].size(-1)
+            span["output_tokens"] = outputs.size(-1) - inputs['input_ids'].size(-1)
+            span["decode_budget"] = max_new_tokens
         response = self.tokenizer.decode(outputs[0][inputs.input_ids.shape[1]:], skip_special_tokens=True)
-        return response, query
\ No newline at end of file
+        return response, query
+
+    def generate_stream(self, text, temperature=0.7, system="You are a chatbot who gives helpful, detailed, and precise answers to the user's questions.", top_p=0.8, max_new_tokens=256,
+                        prefix=None, stop=None, timeout=60.0):
+        """
+        Same as generate, but yields the response as text deltas while it is decoded. Decoding runs in a
+        background thread; closing the iterator early lets the thread finish on its own. An exception in
+        the thread is raised here, and queue.Empty is raised when no delta arrives for `timeout` seconds.
+        """
+        inputs, _ = self._prepare_inputs(text, system, prefix)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=timeout)
+        kwargs = dict(**inputs, do_sample=True, temperature=temperature, top_p=top_p,
+                      max_length=max_new_tokens + inputs['input_ids'].size(-1),
+                      stopping_criteria=self._stopping_criteria(inputs, stop), streamer=streamer)
+        errors = []
+
+        def generate():
+            try:
+                self.model.generate(**kwargs)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # ends the iteration even when generate failed before or while streaming
+                streamer.end()
+
+        thread = threading.Thread(target=generate, daemon=True)
+        with tracer.span("llm.generate_stream") as span:
+            start = time.perf_counter()
+            thread.start()
+            span["prompt_tokens"] = inputs['input_ids'].size(-1)
+            for delta in streamer:
+                if not delta:
+                    continue
+                if "first_token_ms" not in span:
+                    span["first_token_ms"] = (time.perf_counter() - start) * 1000
+                yield delta
+            thread.join()
+            if errors:
+                raise errors[0]
+
+    def _answer_probability(self, logits):
+        # P(Yes) renormalized over the Yes/No tokens only, from the next-token logits of each row
+        logits = logits.float()
+        yes = torch.logsumexp(logits[:, self.yes_ids], dim=-1)
+        no = torch.logsumexp(logits[:, self.no_ids], dim=-1)
+        return torch.sigmoid(yes - no).tolist()
+
+    def score_yes_no(self, text, system="You are a chatbot who gives helpful, detailed, and precise answers to the user's questions.", prefix=None):
+        """
+        Probability that the answer to `text` starts with Yes rather than No, from a single forward pass
+        over the prompt and the assistant header instead of sampling a response.
+        """
+        inputs, _ = self._prepare_inputs(text, system, prefix, suffix=self.ASSISTANT_HEADER)
+        with tracer.span("llm.score") as span:
+            input_ids = inputs['input_ids']
+            past_key_values = inputs.get('past_key_values')
+            if past_key_values is not None:
+                # the cached prefix is already prefilled, only the rest of the prompt is run
+                input_ids = input_ids[:, past_key_values.get_seq_length():]
+            with torch.no_grad():
+                logits = self.model(input_ids=input_ids, attention_mask=inputs['attention_mask'],
+                                    past_key_values=past_key_values, use_cache=past_key_values is not None).logits
+            span["prompt_tokens"] = inputs['input_ids'].size(-1)
+        return self._answer_probability(logits[:, -1])[0]
+
+    def score_yes_no_batch(self, texts, system="You are a chatbot who gives helpful, detailed, and precise answers to the user's questions.",
+                           max_batch_tokens=16384, max_batch_size=32, prefix=None):
+        queries = [self.get_prompt(text, [], system) + self.ASSISTANT_HEADER for text in texts]
+        with tracer.span("llm.tokenize"):
+            lengths = [len(ids) for ids in self._encode(queries, add_special_tokens=False)['input_ids']]
+
+        probabilities = [None] * len(queries)
+        for batch in self._micro_batches(lengths, 0, max_batch_tokens, max_batch_size):
+            inputs = self._prepare_batch_inputs([queries[i] for i in batch], prefix, system)
+
+            with tracer.span("llm.score", batch_size=len(batch)) as span:
+                with torch.no_grad():
+                    # every row ends at the last position, its logits are the next token of every row
+                    past_key_values = inputs.get('past_key_values')
+                    if past_key_values is None:
+                        logits = self.model(**inputs).logits[:, -1]
+                    else:
+                        # only the rest of the prompts is run, at the positions that skip the padding
+                        n = past_key_values.get_seq_length()
+                        position_ids = (inputs['attention_mask'].cumsum(-1) - 1).clamp(min=0)
+                        logits = self.model(input_ids=inputs['input_ids'][:, n:], attention_mask=inputs['attention_mask'],
+                                            past_key_values=past_key_values, position_ids=position_ids[:, n:]).logits[:, -1]
+                span["prompt_tokens"] = sum(lengths[i] for i in batch)
+            for i, p in zip(batch, self._answer_probability(logits)):
+                probabilities[i] = p
+        return probabilities
+
+    def generate_batch(self, texts, temperature=0.7, system="You are a chatbot who gives helpful, detailed, and precise answers to the user's questions.", top_p=0.8, max_new_tokens=256,
+                       max_batch_tokens=16384, max_batch_size=32, stop=None, prefix=None):
+        queries = [self.get_prompt(text, [], system) for text in texts]
+        with tracer.span("llm.tokenize"):
+            lengths = [len(ids) for ids in self._encode(queries, add_special_tokens=False)['input_ids']]
+
+        responses = [None] * len(queries)
+        for batch in self._micro_batches(lengths, max_new_tokens, max_batch_tokens, max_batch_size):
+            inputs = self._prepare_batch_inputs([queries[i] for i in batch], prefix, system)
+
+            with tracer.span("llm.generate", batch_size=len(batch)) as span:
+                # the batch decodes until its last row stops, the output tokens only count the rows still running
+                outputs = self.model.generate(**inputs, do_sample=True, temperature=temperature, top_p=top_p, max_new_tokens=max_new_tokens,
+                                              pad_token_id=self.tokenizer.pad_token_id, stopping_criteria=self._stopping_criteria(inputs, stop))
+                span["prompt_tokens"] = sum(lengths[i] for i in batch)
+                span["output_tokens"] = int((outputs[:, inputs['input_ids'].shape[1]:] != self.tokenizer.pad_token_id).sum())
+                span["decode_budget"] = max_new_tokens * len(batch)
+            decoded = self.tokenizer.batch_decode(outputs[:, inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+            for i, response in zip(batch, decoded):
+                responses[i] = response
+        return list(zip(responses, queries))
+
+    @staticmethod
+    def _micro_batches(lengths, max_new_tokens, max_batch_tokens, max_batch_size):
+        # longest prompts first so each micro-batch holds prompts of similar length,
+        # a batch is closed once its padded size (prompt + new tokens per row) exceeds the token budget
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        batches = []
+        batch = []
+        for i in order:
+            padded_len = lengths[batch[0]] + max_new_tokens if batch else lengths[i] + max_new_tokens
+            if batch and ((len(batch) + 1) * padded_len > max_batch_tokens or len(batch) >= max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
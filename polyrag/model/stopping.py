@@ -0,0 +1,51 @@
+class StopCondition:
+    """
+    Predicate on the text generated so far, the LLM wrappers end decoding (per row in a batch) once it
+    is true. It is true once one of `strings` follows some generated content (an opening ''' fence does
+    not count), or with `balanced_braces` once every "{" opened after `start` (e.g. "SELECT") is closed.
+    With `start`, both only look at the text after it, a preamble such as "Here is the query:\n'''" never stops.
+    """
+
+    def __init__(self, strings=(), balanced_braces=False, start=None):
+        self.strings = list(strings)
+        self.balanced_braces = balanced_braces
+        self.start = start
+
+    @classmethod
+    def from_config(cls, spec):
+        # {"strings": ["'''"], "balanced_braces": true, "start": "SELECT"}, None disables stopping
+        if not spec:
+            return None
+        return cls(spec.get("strings", ()), spec.get("balanced_braces", False), spec.get("start"))
+
+    def _after_start(self, text):
+        if self.start is None:
+            return text
+        _, found, text = text.partition(self.start)
+        return text if found else None
+
+    def _has_stop_string(self, text):
+        text = text.lstrip()
+        for s in self.strings:
+            body = text[len(s):] if text.startswith(s) else text
+            i = body.find(s)
+            if i > 0 and body[:i].strip():
+                return True
+        return False
+
+    def _braces_closed(self, text):
+        depth = 0
+        for c in text:
+            if c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+                if depth <= 0:
+                    return True
+        return False
+
+    def __call__(self, text):
+        text = self._after_start(text)
+        if text is None:
+            return False
+        return self._has_stop_string(text) or (self.balanced_braces and self._braces_closed(text))
@@ -0,0 +1,107 @@
+import re
+import zlib
+import numpy as np
+from polyrag.model.stopping import StopCondition
+from polyrag.util.tracing import tracer
+
+
+class StubLLM:
+    """
+    Deterministic stand-in for Llama3 with the same generate/generate_batch interface,
+    so the pipeline and the service can run without a GPU or model weights.
+    `sparql` and `agreement` map a substring of the question to the canned S1 output and
+    S2 "Yes"/"No" output, anything else is answered with `answer`.
+    """
+
+    def __init__(self, sparql=None, agreement=None, answer="I don't know."):
+        self.sparql = sparql or {}
+        self.agreement = agreement or {}
+        self.answer = answer
+        self.calls = 0
+
+    @staticmethod
+    def _lookup(responses, question, default):
+        for key, response in responses.items():
+            if key in question:
+                return response
+        return default
+
+    def _respond(self, text):
+        # the S1/S2 templates end with the question being asked
+        question = text.rsplit("Question:", 1)[-1].split("\n", 1)[0]
+        if "SPARQL:" in text:
+            return self._lookup(self.sparql, question, "'''")
+        if "Able to answer the question:" in text:
+            return self._lookup(self.agreement, question, "No")
+        return self.answer
+
+    @staticmethod
+    def _decode(response, max_new_tokens, stop):
+        # simulated decoding: words, spaces and punctuation are the tokens, the end of the response is an
+        # EOS token; stops at `stop` or after max_new_tokens as Llama3.generate does. Returns (text, steps)
+        if stop and not callable(stop):
+            stop = StopCondition(stop)
+        tokens = re.findall(r"\w+|\s+|[^\w\s]", response)
+        for steps in range(1, min(len(tokens), max_new_tokens) + 1):
+            text = "".join(tokens[:steps])
+            if stop and stop(text):
+                return text, steps
+        if len(tokens) < max_new_tokens:
+            return response, len(tokens) + 1
+        return "".join(tokens[:max_new_tokens]), max_new_tokens
+
+    def generate(self, text, max_new_tokens=256, stop=None, **kwargs):
+        self.calls += 1
+        with tracer.span("llm.generate") as span:
+            response, steps = self._decode(self._respond(text), max_new_tokens, stop)
+            span["output_tokens"] = steps
+            span["decode_budget"] = max_new_tokens
+            return response, text
+
+    def score_yes_no(self, text, **kwargs):
+        # probability of "Yes" as Llama3.score_yes_no returns it, 1.0 or 0.0 for the canned output
+        self.calls += 1
+        with tracer.span("llm.score"):
+            return 1.0 if "Yes" in self._respond(text) else 0.0
+
+    def score_yes_no_batch(self, texts, **kwargs):
+        self.calls += 1
+        with tracer.span("llm.score", batch_size=len(texts)):
+            return [1.0 if "Yes" in self._respond(text) else 0.0 for text in texts]
+
+    def generate_stream(self, text, **kwargs):
+        # yields the response word by word, as Llama3.generate_stream yields decoded token deltas
+        self.calls += 1
+        with tracer.span("llm.generate_stream"):
+            words = self._respond(text).split(" ")
+            for i, word in enumerate(words):
+                yield word if i == 0 else " " + word
+
+    def generate_batch(self, texts, max_new_tokens=256, stop=None, **kwargs):
+        self.calls += 1
+        with tracer.span("llm.generate", batch_size=len(texts)) as span:
+            decoded = [self._decode(self._respond(text), max_new_tokens, stop) for text in texts]
+            span["output_tokens"] = sum(steps for _, steps in decoded)
+            span["decode_budget"] = max_new_tokens * len(texts)
+            return [(response, text) for (response, _), text in zip(decoded, texts)]
+
+
+class StubEncoder:
+    """
+    Deterministic stand-in for the SentenceTransformer encoder: each text maps to a fixed
+    pseudo-random unit vector seeded by its crc32, so searches run without model weights.
+    """
+
+    def __init__(self, dim=384):
+        self.dim = dim
+        self.calls = 0
+        # key in the query-embedding cache, the vectors only depend on the dimension
+        self.encoder_id = f"stub-{dim}"
+
+    def encode(self, texts, batch_size=None, **kwargs):
+        self.calls += 1
+        texts = [texts] if isinstance(texts, str) else texts
+        vectors = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            vectors[i] = np.random.default_rng(zlib.crc32(text.encode("utf-8"))).standard_normal(self.dim)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
@@ -0,0 +1,274 @@
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from polyrag.model.PolyRAG import PolyRAG
+from polyrag.util.tracing import tracer
+
+
+class PolyRAGService:
+    """
+    Asyncio front-end that keeps one PolyRAG pipeline (model, ontology graph, embedding indexes) warm.
+    Concurrent requests are collected for up to `max_wait_ms` into micro-batches of at most
+    `max_batch_size` questions, each micro-batch goes through PolyRAG.run_batch so every stage
+    runs batched. The request queue is bounded, callers wait for a free slot when it is full.
+    Streamed final answers are generated in their own lane of at most `max_streams` concurrent
+    generations, so a long answer never holds up the retrieval micro-batches.
+    """
+
+    def __init__(self, poly, model, max_batch_size=32, max_wait_ms=5, max_queue_size=256, max_streams=2):
+        self.poly = poly
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self.queue = None
+        self._worker = None
+        # the requests taken off the queue and not answered yet
+        self._batch = []
+        # the pipeline is not thread-safe, all batches run one after the other on a single thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="polyrag-service")
+        # answer generation only uses the model, streams wait for a free slot instead of queueing on the executor
+        self.max_streams = max_streams
+        self._answer_executor = ThreadPoolExecutor(max_workers=max_streams, thread_name_prefix="polyrag-answer")
+        self._streams = None
+        self.stats = {"requests": 0, "batches": 0, "max_batch_size": 0, "errors": 0}
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._streams = asyncio.Semaphore(self.max_streams)
+        self._worker = asyncio.create_task(self._batch_loop())
+
+    async def stop(self):
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+        # the interrupted batch and the queued requests are never answered, fail them instead of leaving their callers waiting
+        pending = self._batch
+        self._batch = []
+        while self.queue is not None and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("The service is stopped"))
+        self._executor.shutdown(wait=True)
+        self._answer_executor.shutdown(wait=True)
+        self.poly.close()
+
+    async def answer(self, question):
+        # returns the tracker record of the question
+        if self._worker is None:
+            raise RuntimeError("The service is not started")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((question, future))
+        if self._worker is None:
+            # stopped while waiting for a free slot
+            raise RuntimeError("The service is stopped")
+        return await future
+
+    async def answer_stream(self, question):
+        """
+        Async generator: yields the tracker record of the question once retrieval is done, then the final
+        answer as text deltas. Generation runs in the answer lane, its deltas are relayed to the loop.
+        """
+        record = await self.answer(question)
+        yield record
+        async with self._streams:
+            async for delta in self._generate_answer(question, record["context"]):
+                yield delta
+
+    async def _generate_answer(self, question, context):
+        loop = asyncio.get_running_loop()
+        deltas = asyncio.Queue()
+        done = object()
+
+        def generate():
+            try:
+                for delta in self.poly.stream_answer(self.model, question, context):
+                    loop.call_soon_threadsafe(deltas.put_nowait, delta)
+            except Exception as e:
+                loop.call_soon_threadsafe(deltas.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(deltas.put_nowait, done)
+
+        generation = loop.run_in_executor(self._answer_executor, generate)
+        while (delta := await deltas.get()) is not done:
+            if isinstance(delta, Exception):
+                raise delta
+            yield delta
+        await generation
+
+    async def _next_batch(self):
+        batch = self._batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _run_batch(self, questions):
+        tracker = self.poly.run_batch(self.model, questions)
+        records = tracker.tracker[-len(questions):]
+        # the batch spans are only stored in the first record, every response reports them
+        spans = records[0].get("spans", [])
+        return [dict(record, spans=spans) for record in records]
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            questions = [question for question, _ in batch]
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(batch)
+            self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+            try:
+                records = await loop.run_in_executor(self._executor, self._run_batch, questions)
+            except Exception as e:
+                if len(batch) == 1:
+                    records = [e]
+                else:
+                    # retry one by one so a bad question only fails its own request
+                    records = []
+                    for question in questions:
+                        try:
+                            records.extend(await loop.run_in_executor(self._executor, self._run_batch, [question]))
+                        except Exception as e:
+                            records.append(e)
+            for (_, future), record in zip(batch, records):
+                # questions no stage answered are recorded with success_round 0 and an error
+                if not isinstance(record, Exception) and record["success_round"] == 0:
+                    record = RuntimeError(record["error"])
+                if isinstance(record, Exception):
+                    self.stats["errors"] += 1
+                if not future.done():
+                    if isinstance(record, Exception):
+                        future.set_exception(record)
+                    else:
+                        future.set_result(record)
+            self._batch = []
+
+    def metrics(self):
+        # span metrics of the pipeline plus the service counters
+        return {"spans": tracer.metrics.to_dict(), "service": dict(self.stats),
+                "queue_size": self.queue.qsize() if self.queue is not None else 0}
+
+    def metrics_text(self):
+        extra = {f"polyrag_service_{key}": value for key, value in self.stats.items()}
+        extra["polyrag_service_queue_size"] = self.queue.qsize() if self.queue is not None else 0
+        return tracer.metrics.prometheus_text(extra)
+
+    async def handle_connection(self, reader, writer):
+        # one JSON object per line: {"question": "..."} -> {"question", "success_round", "context", "spans"},
+        # {"metrics": true} -> the metrics as JSON, {"question": "...", "stream": true} -> one {"delta": "..."}
+        # line per piece of the generated answer, then {"done": true, "answer", "question", "success_round", ...}
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    if request.get("metrics"):
+                        response = self.metrics()
+                    elif request.get("stream"):
+                        response = await self._write_stream(request["question"], writer)
+                    else:
+                        question = request["question"]
+                        record = await self.answer(question)
+                        response = {"question": question, "success_round": record["success_round"],
+                                    "context": record["context"], "spans": record.get("spans", [])}
+                except Exception as e:
+                    response = {"error": str(e)}
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _write_stream(self, question, writer):
+        stream = self.answer_stream(question)
+        record = await anext(stream)
+        answer = []
+        async for delta in stream:
+            answer.append(delta)
+            writer.write((json.dumps({"delta": delta}) + "\n").encode())
+            await writer.drain()
+        return {"done": True, "answer": "".join(answer), "question": question, "success_round": record["success_round"],
+                "context": record["context"], "spans": record.get("spans", [])}
+
+    async def handle_metrics(self, reader, writer):
+        # minimal HTTP endpoint for scrapers: GET /metrics (Prometheus text) or GET /metrics.json
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()).strip():
+                pass
+            path = request_line[1] if len(request_line) > 1 else "/"
+            if path == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.metrics_text()
+            elif path == "/metrics.json":
+                status, content_type, body = "200 OK", "application/json", json.dumps(self.metrics())
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "not found\n"
+            body = body.encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8765, metrics_port=None):
+        await self.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"PolyRAG service listening on {host}:{port}")
+        metrics_server = None
+        if metrics_port is not None:
+            metrics_server = await asyncio.start_server(self.handle_metrics, host, metrics_port)
+            print(f"Metrics at http://{host}:{metrics_port}/metrics")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
+            await self.stop()
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve PolyRAG over a JSON-lines TCP socket")
+    parser.add_argument("--config", default="config.json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5)
+    parser.add_argument("--max_queue_size", type=int, default=256)
+    parser.add_argument("--max_streams", type=int, default=2, help="concurrent streamed answer generations")
+    parser.add_argument("--metrics_port", type=int, default=None, help="serve /metrics and /metrics.json over HTTP")
+    parser.add_argument("--stub", action="store_true", help="use the stub LLM instead of loading model weights")
+    args = parser.parse_args()
+
+    config = json.load(open(args.config, "r"))
+    poly = PolyRAG(config)
+    # load the stages' components before accepting requests
+    poly.warmup()
+    poly.print_startup_report()
+    if args.stub:
+        from polyrag.model.stub import StubLLM
+        model = StubLLM()
+    elif config['model_name'] == "llama3":
+        from polyrag.model.llm import Llama3
+        model = Llama3(config['model_dir'])
+    else:
+        raise ValueError("Model not supported")
+
+    service = PolyRAGService(poly, model, max_batch_size=args.max_batch_size,
+                             max_wait_ms=args.max_wait_ms, max_queue_size=args.max_queue_size,
+                             max_streams=args.max_streams)
+    asyncio.run(service.serve(args.host, args.port, args.metrics_port))
@@ -0,0 +1,155 @@
+import os
+import time
+import argparse
+import numpy as np
+
+
+def normalize_rows(x):
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return x / norms
+
+
+def default_n_probe(n_lists):
+    # about 0.95-0.98 recall@10 on clustered data from 126 to 1264 lists (1k to 100k rows with the default
+    # n_lists), a fixed 8 probes gave 0.66 at 663 lists
+    return min(n_lists, max(64, n_lists // 10))
+
+
+def default_index_path(vector_path):
+    # the index lives next to the embedding file, e.g. poly_kg_embed.npy -> poly_kg_embed.ivf.npz
+    return os.path.splitext(vector_path)[0] + ".ivf.npz"
+
+
+class IVFIndex:
+    """
+    Inverted-file index over cosine similarity. The rows are clustered with spherical k-means,
+    a query only scores the rows of its `n_probe` closest clusters. Larger `n_probe` trades
+    latency for recall, `n_probe == n_lists` is equivalent to exact search; by default it scales
+    with the number of lists (see default_n_probe).
+    `source_mtime` is the mtime of the embedding file the index was built from, see is_fresh.
+    """
+
+    def __init__(self, centroids, list_offsets, list_ids, n_probe=None, source_mtime=None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_ids = np.asarray(list_ids, dtype=np.int64)
+        self.n_lists = self.centroids.shape[0]
+        self.n_probe = n_probe or default_n_probe(self.n_lists)
+        self.source_mtime = source_mtime
+
+    @property
+    def size(self):
+        return len(self.list_ids)
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_iter=10, sample_size=None, seed=0, n_probe=None, chunk_size=8192):
+        n = embeddings.shape[0]
+        if n == 0:
+            raise ValueError("Cannot build an index over an empty embedding matrix")
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+        if sample_size is None:
+            sample_size = 256 * n_lists
+
+        rng = np.random.default_rng(seed)
+        sample_ids = rng.choice(n, size=min(sample_size, n), replace=False)
+        sample = normalize_rows(embeddings[np.sort(sample_ids)])
+
+        # spherical k-means on the training sample
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(n_iter):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            counts = np.bincount(assign, minlength=n_lists)
+            empty = counts == 0
+            # re-seed empty clusters with random sample rows
+            if empty.any():
+                sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = normalize_rows(sums)
+
+        # assign every row to its closest centroid
+        assign = np.empty(n, dtype=np.int64)
+        for start in range(0, n, chunk_size):
+            block = normalize_rows(embeddings[start:start + chunk_size])
+            assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        list_ids = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=n_lists)
+        list_offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(centroids, list_offsets, list_ids, n_probe=n_probe)
+
+    def save(self, path, source_path=None):
+        # `source_path` is the embedding file the index was built from, its mtime is recorded in the index
+        if source_path is not None:
+            self.source_mtime = os.path.getmtime(source_path)
+        extra = {} if self.source_mtime is None else {"source_mtime": self.source_mtime}
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids, **extra)
+
+    @classmethod
+    def load(cls, path, n_probe=None):
+        data = np.load(path)
+        source_mtime = float(data["source_mtime"]) if "source_mtime" in data else None
+        return cls(data["centroids"], data["list_offsets"], data["list_ids"], n_probe=n_probe, source_mtime=source_mtime)
+
+    def is_fresh(self, vector_path, rows):
+        # stale when the embedding file changed after the index was built (e.g. rows updated in place by
+        # polyrag.util.embedding_build) or has another row count, indexes saved without a source are stale
+        if self.size != rows or self.source_mtime is None:
+            return False
+        return not os.path.exists(vector_path) or os.path.getmtime(vector_path) <= self.source_mtime
+
+    def candidates(self, query_embedding, n_probe=None):
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        centroid_scores = self.centroids @ query_embedding
+        if n_probe < self.n_lists:
+            probe = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        else:
+            probe = np.arange(self.n_lists)
+        return np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probe])
+
+    def search(self, query_embeddings, embeddings, k=5, n_probe=None, normalized=False):
+        """
+        Returns (indices, scores), both of shape (n_queries, k), sorted by descending score.
+        Rows of `embeddings` are normalized on the fly unless `normalized` is set.
+        """
+        queries = normalize_rows(np.atleast_2d(query_embeddings))
+        k = min(k, embeddings.shape[0])
+        all_indices = np.empty((len(queries), k), dtype=np.int64)
+        all_scores = np.empty((len(queries), k), dtype=np.float32)
+        for qi, q in enumerate(queries):
+            cand = self.candidates(q, n_probe=n_probe)
+            if len(cand) < k:
+                # not enough rows in the probed clusters, fall back to exact search
+                cand = np.arange(embeddings.shape[0])
+            cand.sort()
+            vectors = embeddings[cand]
+            vectors = vectors.astype(np.float32) if normalized else normalize_rows(vectors)
+            scores = vectors @ q
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+            all_indices[qi] = cand[top]
+            all_scores[qi] = scores[top]
+        return all_indices, all_scores
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an IVF index next to an embedding .npy file")
+    parser.add_argument("vector_path")
+    parser.add_argument("--index_path", default=None)
+    parser.add_argument("--n_lists", type=int, default=None)
+    parser.add_argument("--n_iter", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    index_path = args.index_path or default_index_path(args.vector_path)
+    embeddings = np.load(args.vector_path, mmap_mode="r")
+    start = time.time()
+    index = IVFIndex.build(embeddings, n_lists=args.n_lists, n_iter=args.n_iter, seed=args.seed)
+    index.save(index_path, source_path=args.vector_path)
+    print(f"IVF index with {index.n_lists} lists over {index.size} rows saved to {index_path} ({time.time() - start:.1f}s)")
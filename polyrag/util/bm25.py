@@ -0,0 +1,151 @@
+import os
+import re
+import time
+import json
+import argparse
+import numpy as np
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def default_bm25_path(data_path):
+    # e.g. poly_kg.json -> poly_kg.bm25.npz
+    return os.path.splitext(data_path)[0] + ".bm25.npz"
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a list of short documents (S2 triple labels, S3 chunks), no model needed.
+    Postings are stored CSR-style: the terms are sorted, term i owns doc_ids[offsets[i]:offsets[i + 1]],
+    with the BM25 term weight of each posting precomputed (float32), so a query is a few slices
+    and one scatter-add per term. `search` returns (indices, scores) in the same layout as EmbeddingStore.top_k.
+    """
+
+    def __init__(self, terms, offsets, doc_ids, weights, n_docs, source_mtime=None):
+        # `source_mtime` is the mtime of the data file the index was built from, see is_fresh
+        self.source_mtime = source_mtime
+        self.terms = terms
+        self.term_ids = {t: i for i, t in enumerate(terms)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, documents, k1=1.2, b=0.75):
+        postings = {}
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for d, document in enumerate(documents):
+            tokens = tokenize(document)
+            lengths[d] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                postings.setdefault(token, []).append((d, tf))
+        avg_length = lengths.mean() if len(documents) else 0.0
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(postings[t]) for t in terms], out=offsets[1:])
+        doc_ids = np.empty(offsets[-1], dtype=np.int32)
+        weights = np.empty(offsets[-1], dtype=np.float32)
+        for i, t in enumerate(terms):
+            # ids stay integers, float32 is only exact up to 2**24 rows
+            ids = np.fromiter((d for d, _ in postings[t]), dtype=np.int64, count=len(postings[t]))
+            tf = np.fromiter((f for _, f in postings[t]), dtype=np.float32, count=len(postings[t]))
+            idf = np.log(1 + (len(documents) - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = k1 * (1 - b + b * lengths[ids] / avg_length)
+            doc_ids[offsets[i]:offsets[i + 1]] = ids
+            weights[offsets[i]:offsets[i + 1]] = idf * tf * (k1 + 1) / (tf + norm)
+        return cls(terms, offsets, doc_ids, weights, len(documents))
+
+    def __len__(self):
+        return self.n_docs
+
+    def scores(self, query):
+        # dense score vector over all documents for one query
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for token in set(tokenize(query)):
+            i = self.term_ids.get(token)
+            if i is not None:
+                start, end = self.offsets[i], self.offsets[i + 1]
+                # a term lists each document once, so fancy-index accumulation is exact
+                scores[self.doc_ids[start:end]] += self.weights[start:end]
+        return scores
+
+    def _query_top_k(self, query, k, fill=False):
+        scores = self.scores(query)
+        matched = np.flatnonzero(scores)
+        n = min(k, len(matched))
+        if n == 0:
+            top = np.empty(0, dtype=np.int64)
+        else:
+            top = matched[np.argpartition(-scores[matched], n - 1)[:n]]
+            top = top[np.argsort(-scores[top], kind="stable")]
+        if fill and len(top) < min(k, self.n_docs):
+            # pad with unmatched documents (score 0) in row order
+            unmatched = np.flatnonzero(scores == 0)[:k - len(top)]
+            top = np.concatenate([top, unmatched]).astype(np.int64)
+        return top, scores[top]
+
+    def search(self, queries, k=5, fill=False):
+        # documents without any query term are only returned with `fill`, otherwise rows can be shorter than k
+        results = [self._query_top_k(query, k, fill) for query in queries]
+        return [r[0] for r in results], [r[1] for r in results]
+
+    def save(self, path, source_path=None):
+        # `source_path` is the data file the labels came from, its mtime is recorded in the index
+        if source_path is not None:
+            self.source_mtime = os.path.getmtime(source_path)
+        extra = {} if self.source_mtime is None else {"source_mtime": self.source_mtime}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, terms=np.array(self.terms), offsets=self.offsets, doc_ids=self.doc_ids,
+                     weights=self.weights, n_docs=self.n_docs, **extra)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        source_mtime = float(data["source_mtime"]) if "source_mtime" in data else None
+        return cls(data["terms"].tolist(), data["offsets"], data["doc_ids"], data["weights"], int(data["n_docs"]),
+                   source_mtime=source_mtime)
+
+    def is_fresh(self, data_path, rows):
+        # stale when the data file changed after the index was built, even with the same number of rows
+        if self.n_docs != rows or self.source_mtime is None:
+            return False
+        return os.path.getmtime(data_path) <= self.source_mtime
+
+
+def reciprocal_rank_fusion(rankings, k, c=60):
+    # fuse several ranked lists of row ids, each row scores sum(1 / (c + rank))
+    fused = {}
+    for ranking in rankings:
+        for rank, i in enumerate(ranking.tolist()):
+            fused[i] = fused.get(i, 0.0) + 1.0 / (c + rank + 1)
+    top = sorted(fused, key=fused.get, reverse=True)[:k]
+    return np.array(top, dtype=np.int64), np.array([fused[i] for i in top], dtype=np.float32)
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    from polyrag.util.embedding_search import data_labels
+
+    parser = argparse.ArgumentParser(description="Build a BM25 index over the labels of a KG/corpus file")
+    parser.add_argument("data_path")
+    parser.add_argument("--stage", type=int, default=2, choices=[2, 3])
+    parser.add_argument("--index_path", default=None)
+    args = parser.parse_args()
+
+    start = time.time()
+    index = BM25Index.build(data_labels(json.load(open(args.data_path, "r")), args.stage))
+    index_path = args.index_path or default_bm25_path(args.data_path)
+    index.save(index_path, source_path=args.data_path)
+    print(f"BM25 index over {len(index)} rows ({len(index.terms)} terms, {len(index.doc_ids)} postings) "
+          f"saved to {index_path} ({time.time() - start:.1f}s)")
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+from polyrag.util.ann_index import IVFIndex, default_index_path
+from polyrag.util.embedding_store import build_embedding_store, default_store_path
+from polyrag.util.embedding_search import data_labels
+
+
+def default_hashes_path(vector_path):
+    # e.g. poly_kg_embed.npy -> poly_kg_embed.hashes.npz
+    return os.path.splitext(vector_path)[0] + ".hashes.npz"
+
+
+def content_hashes(labels):
+    # one sha1 digest per row text, rows with the same text and encoder have the same embedding
+    return np.array([hashlib.sha1(label.encode("utf-8")).digest() for label in labels], dtype="S20")
+
+
+def save_hashes(path, hashes, encoder_id):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, hashes=hashes, encoder_id=np.array(encoder_id))
+    os.replace(tmp_path, path)
+
+
+def load_hashes(path):
+    # returns (hashes, encoder_id) or (None, None) when the embeddings have no recorded hashes
+    if not os.path.exists(path):
+        return None, None
+    data = np.load(path)
+    return data["hashes"], str(data["encoder_id"])
+
+
+class EmbeddingBuilder:
+    """
+    Encodes the rows of a KG/corpus file into an .npy embedding matrix, resumable and incremental.
+    Rows are written in chunks into a memory-mapped partial file next to the target, a checkpoint
+    records how many rows are done, so an interrupted build resumes from the last chunk. Every row
+    is keyed by the sha1 of its text: rows whose text was already embedded by the same encoder are
+    copied from the previous matrix, only new or changed rows go through the encoder, and rows that
+    disappeared from the data are dropped.
+    """
+
+    def __init__(self, model, encoder_id, vector_path, batch_size=64, chunk_size=4096):
+        self.model = model
+        self.encoder_id = encoder_id
+        self.vector_path = vector_path
+        self.hashes_path = default_hashes_path(vector_path)
+        self.partial_path = os.path.splitext(vector_path)[0] + ".partial.npy"
+        self.checkpoint_path = os.path.splitext(vector_path)[0] + ".checkpoint.json"
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+
+    def _finish_pending(self):
+        pending_path = self.hashes_path + ".pending"
+        if os.path.exists(pending_path):
+            if os.path.exists(self.partial_path):
+                os.remove(pending_path)
+            else:
+                # the matrix was replaced but not its hashes
+                os.replace(pending_path, self.hashes_path)
+
+    def _previous(self):
+        # {hash: row} of the current matrix, usable only if it was built by the same encoder
+        self._finish_pending()
+        hashes, encoder_id = load_hashes(self.hashes_path)
+        if hashes is None or encoder_id != self.encoder_id or not os.path.exists(self.vector_path):
+            return None, {}
+        previous = np.load(self.vector_path, mmap_mode="r")
+        if len(previous) != len(hashes):
+            return None, {}
+        rows = {}
+        for i, h in enumerate(hashes.tolist()):
+            rows.setdefault(h, i)
+        return previous, rows
+
+    def _signature(self, hashes):
+        return hashlib.sha1(self.encoder_id.encode("utf-8") + hashes.tobytes()).hexdigest()
+
+    def _load_checkpoint(self, signature):
+        if not (os.path.exists(self.checkpoint_path) and os.path.exists(self.partial_path)):
+            return 0
+        checkpoint = json.load(open(self.checkpoint_path, "r"))
+        if checkpoint.get("signature") != signature:
+            return 0
+        return checkpoint["rows_done"]
+
+    def _save_checkpoint(self, signature, rows_done, n_rows):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"signature": signature, "encoder_id": self.encoder_id, "rows_done": rows_done,
+                       "n_rows": n_rows}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _encode(self, texts):
+        return np.atleast_2d(np.asarray(self.model.encode(texts, batch_size=self.batch_size), dtype=np.float32))
+
+    def build(self, labels):
+        """
+        Returns a dict with the number of rows encoded, reused and dropped. The target .npy and its
+        hashes are replaced only once every row is written.
+        """
+        start_time = time.time()
+        hashes = content_hashes(labels)
+        previous, previous_rows = self._previous()
+        reuse = np.array([previous_rows.get(h, -1) for h in hashes.tolist()], dtype=np.int64)
+        n_rows = len(labels)
+        signature = self._signature(hashes)
+        rows_done = self._load_checkpoint(signature)
+        self._save_checkpoint(signature, rows_done, n_rows)
+        out = None
+        if rows_done:
+            out = np.load(self.partial_path, mmap_mode="r+")
+            print(f"Resuming {self.vector_path} from row {rows_done}/{n_rows}")
+
+        encoded = 0
+        for chunk_start in range(rows_done, n_rows, self.chunk_size):
+            chunk = np.arange(chunk_start, min(chunk_start + self.chunk_size, n_rows))
+            missing = chunk[reuse[chunk] < 0]
+            vectors = self._encode([labels[i] for i in missing]) if len(missing) else None
+            if out is None:
+                dim = vectors.shape[1] if vectors is not None else previous.shape[1]
+                out = np.lib.format.open_memmap(self.partial_path, mode="w+", dtype=np.float32, shape=(n_rows, dim))
+            if vectors is not None:
+                out[missing] = vectors
+            kept = chunk[reuse[chunk] >= 0]
+            if len(kept):
+                out[kept] = previous[reuse[kept]]
+            out.flush()
+            encoded += len(missing)
+            self._save_checkpoint(signature, int(chunk[-1]) + 1, n_rows)
+
+        if out is None:
+            # the checkpoint was already complete, or there is no row at all
+            if n_rows:
+                out = np.load(self.partial_path, mmap_mode="r")
+            else:
+                out = np.lib.format.open_memmap(self.partial_path, mode="w+", dtype=np.float32, shape=(0, 0))
+        del out
+        del previous
+        # the new hashes are staged first, a crash between the two renames is completed by _finish_pending
+        save_hashes(self.hashes_path + ".pending", hashes, self.encoder_id)
+        os.replace(self.partial_path, self.vector_path)
+        os.replace(self.hashes_path + ".pending", self.hashes_path)
+        os.remove(self.checkpoint_path)
+        reused = int(np.count_nonzero(reuse >= 0))
+        return {"rows": n_rows, "encoded": encoded, "reused": reused,
+                "dropped": len(previous_rows) - len(set(reuse[reuse >= 0].tolist())),
+                "seconds": time.time() - start_time}
+
+    def adopt(self, labels):
+        # record the hashes of an existing matrix that is known to match `labels` (e.g. the shipped .npy files),
+        # so the next build only encodes what changed
+        n_rows = len(np.load(self.vector_path, mmap_mode="r"))
+        if n_rows != len(labels):
+            raise ValueError(f"{self.vector_path} has {n_rows} rows but the data has {len(labels)}")
+        save_hashes(self.hashes_path, content_hashes(labels), self.encoder_id)
+
+
+def refresh_derived(vector_path, n_lists=None):
+    # the store and the IVF index are derived from the matrix, rebuild the ones that exist
+    store_path = default_store_path(vector_path)
+    if os.path.exists(store_path):
+        dtype = np.load(store_path, mmap_mode="r").dtype.name
+        build_embedding_store(vector_path, store_path, dtype=dtype)
+        print(f"Embedding store {store_path} rebuilt")
+    index_path = default_index_path(vector_path)
+    if os.path.exists(index_path):
+        IVFIndex.build(np.load(vector_path, mmap_mode="r"), n_lists=n_lists).save(index_path, source_path=vector_path)
+        print(f"IVF index {index_path} rebuilt")
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or incrementally update the embeddings of a KG/corpus file")
+    parser.add_argument("data_path", help="e.g. data/poly_kg.json")
+    parser.add_argument("vector_path", help="e.g. data/poly_kg_embed.npy")
+    parser.add_argument("--stage", type=int, default=2, choices=[2, 3])
+    parser.add_argument("--model", default="instructor-xl")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--chunk_size", type=int, default=4096, help="rows between checkpoints")
+    parser.add_argument("--adopt", action="store_true",
+                        help="record hashes for an existing matrix that matches the data, without encoding")
+    parser.add_argument("--n_lists", type=int, default=None)
+    args = parser.parse_args()
+
+    labels = data_labels(json.load(open(args.data_path, "r")), args.stage)
+    if args.adopt:
+        EmbeddingBuilder(None, args.model, args.vector_path).adopt(labels)
+        print(f"Recorded {len(labels)} row hashes for {args.vector_path}")
+    else:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(args.model)
+        builder = EmbeddingBuilder(model, args.model, args.vector_path,
+                                   batch_size=args.batch_size, chunk_size=args.chunk_size)
+        result = builder.build(labels)
+        print(f"{args.vector_path}: {result['rows']} rows, {result['encoded']} encoded, {result['reused']} reused, "
+              f"{result['dropped']} dropped ({result['seconds']:.1f}s)")
+        refresh_derived(args.vector_path, n_lists=args.n_lists)
@@ -0,0 +1,133 @@
+import os
+import atexit
+import pickle
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+
+
+def encoder_identity(model):
+    # the cache key of an encoder: its `encoder_id`, or for a SentenceTransformer the name or path it was loaded
+    # from. A class name is not enough, two SentenceTransformer models would share (and with cache_path persist) keys
+    if getattr(model, "encoder_id", None):
+        return model.encoder_id
+    try:
+        name_or_path = model[0].auto_model.config._name_or_path
+    except (TypeError, IndexError, KeyError, AttributeError):
+        name_or_path = None
+    if name_or_path:
+        return name_or_path
+    raise ValueError(f"Cannot identify the {type(model).__name__} encoder, pass encoder_id")
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings, keyed by (encoder id, normalized query text).
+    One instance is shared by the S2 and S3 EmbeddingSearch so a question is encoded once.
+    """
+
+    def __init__(self, max_size=4096, cache_path=None):
+        self.max_size = max_size
+        self.cache_path = cache_path
+        self._cache = OrderedDict()
+        # S2 and S3 may encode from different threads. The lock only guards the dict, encoding runs outside
+        # it; a query being encoded by one thread is in `_pending` and the other thread waits for its result
+        self._lock = threading.RLock()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        if cache_path and os.path.exists(cache_path):
+            self.load(cache_path)
+        if cache_path:
+            # written back on exit as well as by PolyRAG.close
+            atexit.register(self.save)
+
+    @staticmethod
+    def normalize_text(text):
+        return " ".join(unicodedata.normalize("NFC", text).split())
+
+    def key(self, encoder_id, text):
+        return (encoder_id, self.normalize_text(text))
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, encoder_id, text):
+        key = self.key(encoder_id, text)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+            return None
+
+    def put(self, encoder_id, text, embedding):
+        key = self.key(encoder_id, text)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._cache[key] = embedding
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return embedding
+
+    def encode(self, model, encoder_id, texts):
+        # encode only the cache misses, in one batch
+        owned, waiting = [], []
+        with self._lock:
+            embeddings = [self.get(encoder_id, t) for t in texts]
+            for i, e in enumerate(embeddings):
+                if e is not None:
+                    continue
+                key = self.key(encoder_id, texts[i])
+                if key in self._pending:
+                    waiting.append((i, self._pending[key]))
+                else:
+                    self._pending[key] = threading.Event()
+                    owned.append(i)
+        try:
+            if owned:
+                encoded = np.atleast_2d(model.encode([texts[i] for i in owned]))
+                for i, e in zip(owned, encoded):
+                    embeddings[i] = self.put(encoder_id, texts[i], e)
+        finally:
+            with self._lock:
+                for i in owned:
+                    self._pending.pop(self.key(encoder_id, texts[i])).set()
+        for i, event in waiting:
+            event.wait()
+            with self._lock:
+                embeddings[i] = self._cache.get(self.key(encoder_id, texts[i]))
+            if embeddings[i] is None:
+                # the other thread failed or the entry was already evicted
+                embeddings[i] = self.put(encoder_id, texts[i], np.atleast_2d(model.encode([texts[i]]))[0])
+        return np.stack(embeddings)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self._cache), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, cache_path=None):
+        cache_path = cache_path or self.cache_path
+        if cache_path is None:
+            raise ValueError("No cache path provided")
+        tmp_path = cache_path + ".tmp"
+        with self._lock:
+            items = list(self._cache.items())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(items, f)
+        os.replace(tmp_path, cache_path)
+
+    def load(self, cache_path):
+        with open(cache_path, "rb") as f:
+            items = pickle.load(f)
+        for key, embedding in items[-self.max_size:]:
+            self._cache[key] = embedding
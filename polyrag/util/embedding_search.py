@@ -1,50 +1,184 @@
 import numpy as np
 import os
 import json
-from sklearn.metrics.pairwise import cosine_similarity
+from collections.abc import Sequence
+from polyrag.util.ann_index import IVFIndex, default_index_path, normalize_rows
+from polyrag.util.embedding_store import EmbeddingStore, default_store_path, is_store_fresh
+from polyrag.util.bm25 import BM25Index, default_bm25_path, reciprocal_rank_fusion
+from polyrag.util.label_store import load_labels
+from polyrag.util.embedding_cache import encoder_identity
+from polyrag.util.tracing import tracer
+
+RETRIEVAL_MODES = ("dense", "sparse", "hybrid", "shortlist")
+
+
+def data_labels(data, stage):
+    # the text that is embedded for each row: "sub rel obj" triples for S2, text chunks for S3
+    if stage == 2:
+        return [f"{x['sub']} {x['rel']} {x['obj']}" for x in data]
+    elif stage == 3:
+        return [x['text'] for x in data]
+    else:
+        raise ValueError("Invalid stage number, should be 2 or 3")
+
 
 class EmbeddingSearch:
 
-    def __init__(self, vector_path, data_path, stage=2):
+    def __init__(self, vector_path, data_path, stage=2, index_path=None, n_probe=None, exact=False, store_path=None,
+                 model=None, encoder_id=None, cache=None, retrieval="dense", bm25_path=None, shortlist_size=200,
+                 label_path=None):
+        """
+        `retrieval` selects how rows are ranked: "dense" (encoder + embeddings), "sparse" (BM25 over the
+        labels, no encoder and no embeddings are loaded), "hybrid" (reciprocal rank fusion of both rankings)
+        or "shortlist" (BM25 picks `shortlist_size` candidates that are then scored densely).
+        """
+        if retrieval not in RETRIEVAL_MODES:
+            raise ValueError(f"Invalid retrieval mode {retrieval}, should be one of {RETRIEVAL_MODES}")
+        self.retrieval = retrieval
+        self.shortlist_size = shortlist_size
         self.vector_path = vector_path
-        self.embeddings = np.load(vector_path)
+        # the encoder and the query-embedding cache can be shared between the S2 and S3 instances
+        if model is not None:
+            self.model = model
+            self.encoder_id = encoder_id or encoder_identity(model)
+        self.cache = cache
+        self.n_probe = n_probe
+        self.exact = exact
+        self.index = None
+        self.store = None
+        self.embeddings = None
+        if self.needs_encoder:
+            # prefer the pre-normalized, memory-mapped store built by polyrag.util.embedding_store
+            self.store_path = store_path or default_store_path(vector_path)
+            if is_store_fresh(vector_path, self.store_path):
+                self.store = EmbeddingStore.open(self.store_path)
+            else:
+                if os.path.exists(self.store_path):
+                    print(f"Embedding store {self.store_path} is older than {vector_path}, loading the .npy")
+                self.store = EmbeddingStore.from_array(np.load(vector_path))
+            self.embeddings = self.store.matrix
+            # approximate search is used when an IVF index exists next to the embeddings,
+            # `n_probe` is the recall/latency knob (None scales it with the index) and `exact=True` forces
+            # the brute-force path
+            self.index_path = index_path or default_index_path(vector_path)
+            if not exact and os.path.exists(self.index_path):
+                self.index = IVFIndex.load(self.index_path, n_probe=n_probe)
+                if not self.index.is_fresh(vector_path, len(self.store)):
+                    print(f"IVF index {self.index_path} does not match {vector_path}, using exact search")
+                    self.index = None
         self.data_path = data_path
-        self.data = json.load(open(data_path, "r"))
-        if stage == 2:
-            self.labels = [f"{x['sub']} {x['rel']} {x['obj']}" for x in self.data]
-        elif stage == 3:
-            self.labels = [x['text'] for x in self.data]
-        else:
-            raise ValueError("Invalid stage number, should be 2 or 3")
+        self.stage = stage
+        # labels are interned and built per access, memory-mapped when compiled with polyrag.util.label_store
+        self.labels, self.labels_source, _ = load_labels(data_path, stage, label_path)
+        if self.store is not None and len(self.store) != len(self.labels):
+            raise ValueError(f"{vector_path} has {len(self.store)} rows but {data_path} has {len(self.labels)}, "
+                             f"rebuild the embeddings with polyrag.util.embedding_build")
+        self.bm25 = None
+        if retrieval != "dense":
+            # a saved index (python -m polyrag.util.bm25) is used when it matches the data, building one is cheap
+            self.bm25_path = bm25_path or default_bm25_path(data_path)
+            if os.path.exists(self.bm25_path):
+                self.bm25 = BM25Index.load(self.bm25_path)
+            if self.bm25 is None or not self.bm25.is_fresh(data_path, len(self.labels)):
+                self.bm25 = BM25Index.build(self.labels)
+
+    @property
+    def data(self):
+        # the raw rows are only parsed when something asks for them
+        if not hasattr(self, "_data"):
+            self._data = json.load(open(self.data_path, "r"))
+        return self._data
+
+    @property
+    def needs_encoder(self):
+        return self.retrieval != "sparse"
+
+    def load_embedding_model(self, model_path):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_path)
+        self.encoder_id = model_path
+        return self.model
 
     def unload_embedding_model(self):
         del self.model
 
-    def search_top_k(self, query, k=5, print_result=False):
-        if not isinstance(self.labels, list):
-            raise ValueError('Data must be a list of strings')
-        if not isinstance(self.embeddings, np.ndarray):
+    def encode(self, queries):
+        with tracer.span("search.encode", queries=len(queries)) as span:
+            if self.cache is None:
+                return np.atleast_2d(self.model.encode(queries))
+            misses = self.cache.misses
+            embeddings = self.cache.encode(self.model, self.encoder_id, queries)
+            span["cache_hit"] = self.cache.misses == misses
+            return embeddings
+
+    def build_index(self, n_lists=None, n_iter=10, save=True):
+        self.index = IVFIndex.build(self.embeddings, n_lists=n_lists, n_iter=n_iter, n_probe=self.n_probe)
+        if save:
+            self.index.save(self.index_path, source_path=self.vector_path)
+        return self.index
+
+    def _top_k(self, query_embeddings, k, exact=None):
+        exact = self.exact if exact is None else exact
+        if self.index is not None and not exact:
+            return self.index.search(query_embeddings, self.embeddings, k=k, n_probe=self.n_probe, normalized=True)
+        return self.store.top_k(query_embeddings, k=k)
+
+    def _shortlist_top_k(self, query_embeddings, candidates, k, exact=None):
+        # dense scores over the BM25 candidates only, queries without enough candidates are searched fully
+        indices, scores = [], []
+        queries = normalize_rows(np.atleast_2d(query_embeddings))
+        for query, rows in zip(queries, candidates):
+            if len(rows) < k:
+                top, top_scores = self._top_k(query[None], k, exact=exact)
+                indices.append(top[0])
+                scores.append(top_scores[0])
+                continue
+            rows = np.sort(rows)
+            row_scores = np.asarray(self.embeddings[rows], dtype=np.float32) @ query
+            order = np.argsort(-row_scores, kind="stable")[:k]
+            indices.append(rows[order])
+            scores.append(row_scores[order])
+        return indices, scores
+
+    def _search(self, queries, k, exact=None):
+        with tracer.span("search", retrieval=self.retrieval, queries=len(queries)):
+            return self._rank(queries, k, exact)
+
+    def _rank(self, queries, k, exact=None):
+        # per query row indices and scores, best first
+        if self.retrieval == "sparse":
+            # questions without a known term still get k rows, the last stage must always yield a context
+            return self.bm25.search(queries, k=k, fill=True)
+        if self.retrieval == "shortlist":
+            candidates, _ = self.bm25.search(queries, k=self.shortlist_size)
+            return self._shortlist_top_k(self.encode(queries), candidates, k, exact=exact)
+        if self.retrieval == "dense":
+            return self._top_k(self.encode(queries), k, exact=exact)
+        # hybrid: fuse deeper dense and sparse rankings
+        dense_indices, _ = self._top_k(self.encode(queries), 2 * k, exact=exact)
+        sparse_indices, _ = self.bm25.search(queries, k=2 * k)
+        fused = [reciprocal_rank_fusion([d, s], k) for d, s in zip(dense_indices, sparse_indices)]
+        return [f[0] for f in fused], [f[1] for f in fused]
+
+    def _check_data(self):
+        if not isinstance(self.labels, Sequence):
+            raise ValueError('Data must be a sequence of strings')
+        if self.needs_encoder and not isinstance(self.embeddings, np.ndarray):
             raise ValueError('Embeddings must be a numpy array')
-        query_embedding = self.model.encode(query)
-        query_embedding = query_embedding.reshape(1, -1)
-        cosine_similarities = cosine_similarity(query_embedding, self.embeddings).flatten()
-        top_k_indices = np.argsort(cosine_similarities)[-k:][::-1]
-        top_k_similarities = cosine_similarities[top_k_indices]
+
+    def search_top_k(self, query, k=5, print_result=False, exact=None):
+        self._check_data()
+        top_k_indices, top_k_similarities = self._search([query], k, exact=exact)
+        top_k_indices, top_k_similarities = top_k_indices[0], top_k_similarities[0]
         if print_result:
             print(f"Query: {query}")
             for i, (index, sim) in enumerate(zip(top_k_indices, top_k_similarities)):
                 print(f"{i+1:2d} | {self.labels[index]:30s} | {sim:.2f}")
         return [self.labels[i] for i in top_k_indices]
     
-    def search_top_k_batch(self, queries, k=5, print_result=False):
-        if not isinstance(self.labels, list):
-            raise ValueError('Data must be a list of strings')
-        if not isinstance(self.embeddings, np.ndarray):
-            raise ValueError('Embeddings must be a numpy array')
-        query_embeddings = self.model.encode(queries)
-        cosine_similarities = cosine_similarity(query_embeddings, self.embeddings)
-        top_k_indices = np.argsort(cosine_similarities, axis=1)[:, -k:][:, ::-1]
-        top_k_similarities = np.array([cosine_similarities[i][top_k_indices[i]] for i in range(len(queries))])
+    def search_top_k_batch(self, queries, k=5, print_result=False, exact=None):
+        self._check_data()
+        top_k_indices, top_k_similarities = self._search(queries, k, exact=exact)
         if print_result:
             for i, query in enumerate(queries):
                 print(f"Query: {query}")
@@ -77,8 +211,8 @@ if __name__ == "__main__":
     questions = [bench['question'] for bench in benchmark]
     ground_truths = [bench['ground_truth'] for bench in benchmark]
 
-    search = EmbeddingSearch(model_path, embedding_path, data_path, stage=round)
-    search.load_embedding_model()
+    search = EmbeddingSearch(embedding_path, data_path, stage=round)
+    search.load_embedding_model(model_path)
     contexts = search.search_top_k_batch(questions, k=k, print_result=True)
     search.unload_embedding_model()
 
@@ -0,0 +1,104 @@
+import os
+import time
+import argparse
+import numpy as np
+from polyrag.util.ann_index import normalize_rows
+
+
+def default_store_path(vector_path):
+    # e.g. poly_kg_embed.npy -> poly_kg_embed.store.npy
+    return os.path.splitext(vector_path)[0] + ".store.npy"
+
+
+def is_store_fresh(vector_path, store_path):
+    # the store is derived from the .npy, it is stale when the .npy is newer or has another shape
+    if not os.path.exists(store_path):
+        return False
+    if not os.path.exists(vector_path):
+        return True
+    if os.path.getmtime(store_path) < os.path.getmtime(vector_path):
+        return False
+    return np.load(store_path, mmap_mode="r").shape == np.load(vector_path, mmap_mode="r").shape
+
+
+def build_embedding_store(vector_path, store_path=None, dtype="float32", chunk_size=8192):
+    # normalize the rows once and write them as a plain .npy that can be opened with mmap_mode
+    if dtype not in ("float32", "float16"):
+        raise ValueError("Embedding store dtype should be float32 or float16")
+    store_path = store_path or default_store_path(vector_path)
+    embeddings = np.load(vector_path, mmap_mode="r")
+    if embeddings.ndim != 2:
+        raise ValueError(f"Embeddings in {vector_path} must be a 2D matrix")
+    tmp_path = store_path + ".tmp"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=embeddings.shape)
+    for start in range(0, embeddings.shape[0], chunk_size):
+        out[start:start + chunk_size] = normalize_rows(embeddings[start:start + chunk_size])
+    out.flush()
+    del out
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+class EmbeddingStore:
+    """
+    Row-normalized embedding matrix, scored with a single dot product per query.
+    Stores opened from disk are memory-mapped read-only, so worker processes share the pages.
+    """
+
+    def __init__(self, matrix, store_path=None, chunk_size=65536):
+        self.matrix = matrix
+        self.store_path = store_path
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def open(cls, store_path):
+        return cls(np.load(store_path, mmap_mode="r"), store_path=store_path)
+
+    @classmethod
+    def from_array(cls, embeddings):
+        # fallback when no store has been built, normalize once at load time instead of per query
+        return cls(normalize_rows(embeddings))
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    @property
+    def dtype(self):
+        return self.matrix.dtype
+
+    def scores(self, query_embeddings):
+        queries = normalize_rows(np.atleast_2d(query_embeddings))
+        if self.matrix.dtype == np.float32:
+            return queries @ self.matrix.T
+        # upcast in chunks so float16 stores never materialize a full float32 copy
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), self.chunk_size):
+            block = np.asarray(self.matrix[start:start + self.chunk_size], dtype=np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        return scores
+
+    def top_k(self, query_embeddings, k=5):
+        scores = self.scores(query_embeddings)
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a normalized, memory-mappable embedding store from an .npy file")
+    parser.add_argument("vector_path")
+    parser.add_argument("--store_path", default=None)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    args = parser.parse_args()
+
+    start = time.time()
+    store_path = build_embedding_store(args.vector_path, args.store_path, dtype=args.dtype)
+    print(f"Embedding store saved to {store_path} ({time.time() - start:.1f}s)")
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import argparse
+from collections.abc import Sequence
+import numpy as np
+
+# bump when the layout of the compiled labels changes
+LABEL_FORMAT_VERSION = 1
+
+
+def default_label_path(data_path):
+    # e.g. poly_kg.json -> poly_kg.labels/ (a directory of .npy files that are memory-mapped)
+    return os.path.splitext(data_path)[0] + ".labels"
+
+
+class StringTable(Sequence):
+    """
+    Strings stored back to back in one UTF-8 byte buffer, string i is buffer[offsets[i]:offsets[i + 1]].
+    Both arrays can be memory-mapped, a string is only decoded when it is accessed.
+    """
+
+    def __init__(self, offsets, buffer):
+        self.offsets = offsets
+        self.buffer = buffer
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+        return cls(offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("string index out of range")
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.buffer.nbytes
+
+
+class TripleLabels(Sequence):
+    """
+    S2 rows as interned (sub, rel, obj) term ids in an int32 array plus one StringTable of distinct terms.
+    The "sub rel obj" label of a row is built when it is accessed, e.g. for the top-k results only.
+    """
+
+    def __init__(self, triples, terms):
+        self.triples = triples
+        self.terms = terms
+
+    @classmethod
+    def from_data(cls, data):
+        term_ids = {}
+        triples = np.empty((len(data), 3), dtype=np.int32)
+        for i, x in enumerate(data):
+            triples[i] = [term_ids.setdefault(x[key], len(term_ids)) for key in ("sub", "rel", "obj")]
+        return cls(triples, StringTable.from_strings(term_ids))
+
+    def __len__(self):
+        return len(self.triples)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        s, r, o = self.triples[i]
+        return f"{self.terms[s]} {self.terms[r]} {self.terms[o]}"
+
+    def triple(self, i):
+        s, r, o = self.triples[i]
+        return {"sub": self.terms[s], "rel": self.terms[r], "obj": self.terms[o]}
+
+    @property
+    def nbytes(self):
+        return self.triples.nbytes + self.terms.nbytes
+
+
+def build_labels(data, stage):
+    # the compact equivalent of embedding_search.data_labels
+    if stage == 2:
+        return TripleLabels.from_data(data)
+    elif stage == 3:
+        return StringTable.from_strings(x['text'] for x in data)
+    else:
+        raise ValueError("Invalid stage number, should be 2 or 3")
+
+
+def compile_labels(data_path, stage, label_path=None):
+    label_path = label_path or default_label_path(data_path)
+    labels = build_labels(json.load(open(data_path, "r")), stage)
+    table = labels.terms if stage == 2 else labels
+    os.makedirs(label_path, exist_ok=True)
+    # the format file is written last, a partially written directory is never considered fresh
+    format_path = os.path.join(label_path, "format.json")
+    if os.path.exists(format_path):
+        os.remove(format_path)
+    np.save(os.path.join(label_path, "offsets.npy"), table.offsets)
+    np.save(os.path.join(label_path, "bytes.npy"), table.buffer)
+    if stage == 2:
+        np.save(os.path.join(label_path, "triples.npy"), labels.triples)
+    with open(format_path, "w") as f:
+        json.dump({"format_version": LABEL_FORMAT_VERSION, "stage": stage, "rows": len(labels)}, f)
+    return label_path
+
+
+def is_labels_fresh(data_path, label_path, stage):
+    format_path = os.path.join(label_path, "format.json")
+    if not os.path.exists(format_path) or os.path.getmtime(format_path) < os.path.getmtime(data_path):
+        return False
+    meta = json.load(open(format_path, "r"))
+    return meta.get("format_version") == LABEL_FORMAT_VERSION and meta.get("stage") == stage
+
+
+def open_labels(label_path, stage):
+    table = StringTable(np.load(os.path.join(label_path, "offsets.npy"), mmap_mode="r"),
+                        np.load(os.path.join(label_path, "bytes.npy"), mmap_mode="r"))
+    if stage == 2:
+        return TripleLabels(np.load(os.path.join(label_path, "triples.npy"), mmap_mode="r"), table)
+    return table
+
+
+def load_labels(data_path, stage, label_path=None):
+    """
+    Returns (labels, source, seconds). The compiled labels are memory-mapped when they are newer than
+    the data file, otherwise the JSON is parsed and interned in memory.
+    """
+    label_path = label_path or default_label_path(data_path)
+    start = time.time()
+    if is_labels_fresh(data_path, label_path, stage):
+        return open_labels(label_path, stage), "compiled", time.time() - start
+    labels = build_labels(json.load(open(data_path, "r")), stage)
+    return labels, "json", time.time() - start
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the labels of a KG/corpus file into memory-mappable arrays")
+    parser.add_argument("data_path")
+    parser.add_argument("--stage", type=int, default=2, choices=[2, 3])
+    parser.add_argument("--label_path", default=None)
+    args = parser.parse_args()
+
+    label_path = compile_labels(args.data_path, args.stage, args.label_path)
+    labels, source, seconds = load_labels(args.data_path, args.stage, label_path)
+    start = time.time()
+    json.load(open(args.data_path, "r"))
+    parse_time = time.time() - start
+    print(f"{len(labels)} labels compiled to {label_path} ({labels.nbytes / 1024**2:.1f} MB)")
+    print(f"Cold start: json {parse_time:.3f}s, {source} {seconds:.3f}s")
@@ -0,0 +1,114 @@
+import os
+import pickle
+import numpy as np
+from rdflib import Literal
+from rdflib.namespace import XSD
+
+# bump when the layout of the saved index changes
+INDEX_FORMAT_VERSION = 2
+
+
+def default_index_path(ontology_path):
+    # e.g. polyu_onto.ttl -> polyu_onto.literals.pkl
+    return os.path.splitext(ontology_path)[0] + ".literals.pkl"
+
+
+def is_string_literal(term):
+    return isinstance(term, Literal) and term.datatype in (None, XSD.string)
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class LiteralIndex:
+    """
+    Trigram inverted index over the lowercased string literals of each predicate.
+    `contains(predicate, needle)` returns the literals whose lowercased value contains the
+    lowercased needle, by intersecting the postings of the needle's trigrams and verifying
+    the few remaining candidates. Needles shorter than 3 characters are answered by a scan.
+    """
+
+    def __init__(self, literals, lowered, postings, verify_threshold=32):
+        self.literals = literals
+        self.lowered = lowered
+        self.postings = postings
+        self.verify_threshold = verify_threshold
+
+    @classmethod
+    def build(cls, graph):
+        literals = {}
+        seen = {}
+        for _, p, o in graph:
+            if is_string_literal(o) and o not in seen.setdefault(p, set()):
+                seen[p].add(o)
+                literals.setdefault(p, []).append(o)
+        lowered = {p: [str(o).lower() for o in values] for p, values in literals.items()}
+        postings = {}
+        for p, values in lowered.items():
+            grams = {}
+            for i, value in enumerate(values):
+                for gram in trigrams(value):
+                    grams.setdefault(gram, []).append(i)
+            # compact postings: one id array per predicate, each trigram maps to a (start, end) slice of it
+            offsets = {}
+            ids = []
+            for gram, gram_ids in grams.items():
+                offsets[gram] = (len(ids), len(ids) + len(gram_ids))
+                ids.extend(gram_ids)
+            postings[p] = (offsets, np.array(ids, dtype=np.int32))
+        return cls(literals, lowered, postings)
+
+    def predicates(self):
+        return list(self.literals)
+
+    def candidates(self, predicate, needle):
+        # ids of the literals of `predicate` whose lowercased value contains `needle` (already lowercased)
+        values = self.lowered.get(predicate, [])
+        if len(needle) < 3:
+            return [i for i, value in enumerate(values) if needle in value]
+        offsets, ids = self.postings.get(predicate, ({}, None))
+        spans = []
+        for gram in trigrams(needle):
+            if gram not in offsets:
+                return []
+            spans.append(offsets[gram])
+        spans.sort(key=lambda span: span[1] - span[0])
+        # intersect the rarest postings until few candidates are left, then verify them directly
+        candidates = ids[spans[0][0]:spans[0][1]]
+        for start, end in spans[1:]:
+            if len(candidates) <= self.verify_threshold:
+                break
+            candidates = candidates[np.isin(candidates, ids[start:end], assume_unique=True)]
+        return [i for i in candidates.tolist() if needle in values[i]]
+
+    def contains(self, predicate, needle):
+        needle = needle.lower()
+        return [self.literals[predicate][i] for i in self.candidates(predicate, needle)]
+
+    def search(self, needle, predicates=None):
+        # {predicate: [literals]} over all (or the given) predicates, for entity candidate lookup
+        predicates = self.predicates() if predicates is None else predicates
+        results = {}
+        for p in predicates:
+            found = self.contains(p, needle)
+            if found:
+                results[p] = found
+        return results
+
+    def save(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"format_version": INDEX_FORMAT_VERSION, "literals": self.literals, "postings": self.postings}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("format_version") != INDEX_FORMAT_VERSION:
+            return None
+        literals = data["literals"]
+        lowered = {p: [str(o).lower() for o in values] for p, values in literals.items()}
+        return cls(literals, lowered, data["postings"])
@@ -1,20 +1,146 @@
 import os
+import re
 import json
-from rdflib import Graph, Namespace
+import time
+import ctypes
+import threading
+from itertools import islice
+from collections import OrderedDict
+from rdflib import Namespace, Variable
+from rdflib.plugins.sparql import prepareQuery
+from polyrag.util.ontology_store import load_graph
+from polyrag.util.sparql_fastpath import SparqlFastPath
+from polyrag.util.literal_index import LiteralIndex, default_index_path
+from polyrag.util.tracing import tracer
 
 # ignore the value error
 import logging
 logging.getLogger("rdflib.term").setLevel(logging.ERROR)
 
 
+class QueryTimeout(Exception):
+    pass
+
+
+class QueryResultCache:
+    # LRU cache with TTL for SPARQL results, failed (None) results are cached as well
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        # returns (found, result)
+        entry = self._cache.get(key)
+        if entry is not None and (self.ttl is None or time.time() - entry[1] < self.ttl):
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+        if entry is not None:
+            del self._cache[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, result):
+        self._cache[key] = (result, time.time())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return {"size": len(self._cache), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
 class OntologyQuery:
 
-    def __init__(self, ontology_path, namespace="http://example.org/"):
+    def __init__(self, ontology_path, namespace="http://example.org/", cache_size=1024, cache_ttl=3600, check_interval=1.0,
+                 store_path=None, use_store=True, fastpath=True, literal_index_path=None, timeout=5.0):
         self.ontology_path = ontology_path
-        self.g = Graph()
-        self.g.parse(ontology_path, format="turtle")
+        # a store compiled by polyrag.util.ontology_store is loaded instead of parsing the turtle file
+        self.store_path = store_path
+        self.use_store = use_store
+        self.literal_index_path = literal_index_path or default_index_path(ontology_path)
+        # the templated S1 query shapes are answered from native indexes, the rest goes to rdflib
+        self.use_fastpath = fastpath
+        # wall-clock limit for rdflib evaluation, the outcome of every query is counted in query_stats
+        self.timeout = timeout
+        self.last_status = None
+        self.query_stats = {}
         self.namespace = Namespace(namespace)
+        self.load()
+        # results are cached on the normalized query, the cache is dropped when the ontology file changes
+        self.cache = QueryResultCache(max_size=cache_size, ttl=cache_ttl) if cache_size else None
+        self.check_interval = check_interval
+        self._last_check = time.time()
+
+    def _file_signature(self):
+        stat = os.stat(self.ontology_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def load(self):
+        self.signature = self._file_signature()
+        self.g, self.load_source, self.load_time = load_graph(self.ontology_path, self.store_path, use_store=self.use_store)
         self.g.bind("base", self.namespace)
+        self.literal_index = self.load_literal_index()
+        self._fastpath = None
+
+    def load_literal_index(self):
+        # restore the trigram index over literal values when it is newer than the ontology, otherwise build it
+        path = self.literal_index_path
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(self.ontology_path):
+            index = LiteralIndex.load(path)
+            if index is not None:
+                return index
+        return LiteralIndex.build(self.g)
+
+    def find_entities(self, text, predicate=None):
+        # (subject, predicate, literal) for every literal containing `text`, case-insensitively
+        predicates = [self.namespace[predicate]] if predicate else None
+        entities = []
+        for p, literals in self.literal_index.search(text, predicates).items():
+            for literal in literals:
+                entities.extend((s, p, literal) for s in self.fastpath.op[p][literal])
+        return entities
+
+    @property
+    def fastpath(self):
+        # built on first use and rebuilt after the ontology is reloaded
+        if self._fastpath is None:
+            self._fastpath = SparqlFastPath(self.g, namespaces={"base": self.namespace}, literal_index=self.literal_index)
+        return self._fastpath
+
+    def check_ontology(self):
+        # reload the graph and invalidate cached results if the ontology file was modified
+        now = time.time()
+        if now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+        if self._file_signature() == self.signature:
+            return False
+        self.load()
+        if self.cache is not None:
+            self.cache.clear()
+        return True
+
+    @staticmethod
+    def normalize_query(query):
+        # collapse whitespace outside of string literals
+        if not query:
+            return None
+        parts = re.split(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')', query)
+        parts = [p if i % 2 else " ".join(p.split()) for i, p in enumerate(parts)]
+        return " ".join(p for p in parts if p)
+
+    def cache_key(self, query, max_result, return_text, return_list, return_anstext):
+        return (self.normalize_query(query), max_result, return_text, return_list, return_anstext)
 
     def qres_to_text(self, qres):
         res = ""
@@ -36,10 +162,118 @@ class OntologyQuery:
         return (','.join(res) if res else None)
     
     def query(self, query, max_result=8, return_text=False, return_list=False, return_anstext=True):
+        with tracer.span("sparql.execute") as span:
+            result = self._cached_query(query, max_result, return_text, return_list, return_anstext)
+            span["status"] = self.last_status
+            if self.cache is not None:
+                span["cache_hit"] = self.last_status == "cached"
+        return result
+
+    def _cached_query(self, query, max_result=8, return_text=False, return_list=False, return_anstext=True):
+        # raw result objects are consumed by iteration, only converted results are cached
+        if self.cache is None or not (return_text or return_list or return_anstext):
+            return self._query(query, max_result, return_text, return_list, return_anstext)
+        self.check_ontology()
+        key = self.cache_key(query, max_result, return_text, return_list, return_anstext)
+        found, result = self.cache.get(key)
+        if found:
+            self._record("cached")
+        else:
+            result = self._query(query, max_result, return_text, return_list, return_anstext)
+            # a timeout says nothing about the result, the query may finish when the graph is less busy
+            if self.last_status != "timeout":
+                self.cache.put(key, result)
+        return list(result) if isinstance(result, list) else result
+
+    def _record(self, status):
+        self.last_status = status
+        self.query_stats[status] = self.query_stats.get(status, 0) + 1
+
+    def _bgps(self, node):
+        if getattr(node, "name", None) == "BGP":
+            yield node
+        if isinstance(node, dict):
+            for value in node.values():
+                yield from self._bgps(value)
+        elif isinstance(node, (list, tuple)):
+            for value in node:
+                yield from self._bgps(value)
+
+    def check_cost(self, prepared):
+        # reject patterns that make rdflib enumerate the graph: all-variable triples and cross products
+        for bgp in self._bgps(prepared.algebra):
+            triples = bgp.get("triples") or []
+            if any(all(isinstance(t, Variable) for t in triple) for triple in triples):
+                return "unbounded_pattern"
+            components = []
+            for triple in triples:
+                variables = {t for t in triple if isinstance(t, Variable)}
+                if not variables:
+                    # a ground triple (e.g. base:AMA a base:DEPARTMENT) is a constant check, not a cross product
+                    continue
+                linked = [c for c in components if c & variables]
+                merged = variables.union(*linked)
+                components = [c for c in components if not (c & variables)] + [merged]
+            if len(components) > 1:
+                return "cross_product"
+        return None
+
+    def _stream(self, prepared, limit):
+        # rdflib yields SELECT rows lazily, stop as soon as `limit` rows are known
+        return list(islice(self.g.query(prepared), limit))
+
+    def _stream_with_timeout(self, prepared, limit):
+        if not self.timeout:
+            return self._stream(prepared, limit)
+        result = {}
+
+        def work():
+            try:
+                result["rows"] = self._stream(prepared, limit)
+            except QueryTimeout:
+                pass
+            except Exception as e:
+                result["error"] = e
+
+        worker = threading.Thread(target=work, daemon=True)
+        worker.start()
+        worker.join(self.timeout)
+        if worker.is_alive():
+            # rdflib is pure python, interrupt the evaluation by raising in the worker thread
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(worker.ident), ctypes.py_object(QueryTimeout))
+            raise QueryTimeout(f"Query did not finish in {self.timeout}s")
+        if "error" in result:
+            raise result["error"]
+        return result["rows"]
+
+    def execute(self, query, max_result=8):
+        # returns (rows, status), rows is None unless the query succeeded with at most max_result rows
+        if not query:
+            return None, "error"
+        rows = self.fastpath.execute(query, limit=max_result + 1) if self.use_fastpath else None
+        if rows is None:
+            try:
+                prepared = prepareQuery(query, initNs={"base": self.namespace})
+            except Exception:
+                return None, "error"
+            if self.check_cost(prepared):
+                return None, "rejected"
+            try:
+                rows = self._stream_with_timeout(prepared, max_result + 1)
+            except QueryTimeout:
+                return None, "timeout"
+            except Exception:
+                return None, "error"
+        if len(rows) > max_result:
+            return None, "too_many"
+        return rows, ("success" if rows else "empty")
+
+    def _query(self, query, max_result=8, return_text=False, return_list=False, return_anstext=True):
+        qres, status = self.execute(query, max_result=max_result)
+        self._record(status)
+        if qres is None:
+            return None
         try:
-            qres = self.g.query(query, initNs={"base": self.namespace})
-            if len(qres) > max_result:
-                return None
             if return_text:
                 return self.qres_to_text(qres)
             elif return_list:
@@ -49,6 +283,7 @@ class OntologyQuery:
             else:
                 return qres
         except Exception as e:
+            self.query_stats["error"] = self.query_stats.get("error", 0) + 1
             return None
         
     def get_batch_clean_query(self, llm_output_path):
@@ -86,6 +321,10 @@ class OntologyQuery:
         return query_results
     
     def get_clean_query(self, llm_output):
+        with tracer.span("sparql.clean"):
+            return self._clean_query(llm_output)
+
+    def _clean_query(self, llm_output):
         sparql = llm_output
         if ("SELECT" not in sparql) or ("}" not in sparql):
             return None
@@ -107,6 +346,22 @@ class OntologyQuery:
             print(results)
         return results
 
+    def get_query_results(self, llm_outputs, max_result=8, print_result=False,
+                          return_text=False, return_list=False, return_anstext=True):
+        # batched get_query_result, identical cleaned queries in the batch are executed once
+        assert sum([return_text, return_list, return_anstext]) == 1, "Only one of return_text, return_list, return_anstext can be True"
+        cleaned_queries = [self.get_clean_query(output) for output in llm_outputs]
+        unique_results = {}
+        for q in cleaned_queries:
+            if q not in unique_results:
+                unique_results[q] = self.query(q, max_result=max_result,
+                                               return_text=return_text, return_list=return_list, return_anstext=return_anstext)
+        results = [unique_results[q] for q in cleaned_queries]
+        if print_result:
+            for i, r in enumerate(results):
+                print(f'Query {i+1} ', r)
+        return results
+
 
 
 # ============================================
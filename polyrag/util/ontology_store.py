@@ -0,0 +1,76 @@
+import os
+import time
+import pickle
+import argparse
+import rdflib
+from rdflib import Graph
+from polyrag.util.literal_index import LiteralIndex, default_index_path
+
+# bump when the layout of the compiled store changes
+STORE_FORMAT_VERSION = 1
+
+
+def default_store_path(ontology_path):
+    # e.g. polyu_onto.ttl -> polyu_onto.graph.pkl
+    return os.path.splitext(ontology_path)[0] + ".graph.pkl"
+
+
+def parse_ontology(ontology_path):
+    g = Graph()
+    g.parse(ontology_path, format="turtle")
+    return g
+
+
+def compile_ontology(ontology_path, store_path=None, literal_index_path=None):
+    # parse the turtle file once and pickle the in-memory triple index, along with the literal trigram index
+    store_path = store_path or default_store_path(ontology_path)
+    g = parse_ontology(ontology_path)
+    LiteralIndex.build(g).save(literal_index_path or default_index_path(ontology_path))
+    tmp_path = store_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"format_version": STORE_FORMAT_VERSION, "rdflib": rdflib.__version__, "graph": g}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+def is_store_fresh(ontology_path, store_path):
+    return os.path.exists(store_path) and os.path.getmtime(store_path) >= os.path.getmtime(ontology_path)
+
+
+def load_store(store_path):
+    with open(store_path, "rb") as f:
+        data = pickle.load(f)
+    if data.get("format_version") != STORE_FORMAT_VERSION or data.get("rdflib") != rdflib.__version__:
+        return None
+    return data["graph"]
+
+
+def load_graph(ontology_path, store_path=None, use_store=True):
+    """
+    Returns (graph, source, seconds). The compiled store is used when it exists, is newer than the
+    turtle file and was written by the same rdflib version, otherwise the turtle file is parsed.
+    """
+    store_path = store_path or default_store_path(ontology_path)
+    start = time.time()
+    if use_store and is_store_fresh(ontology_path, store_path):
+        g = load_store(store_path)
+        if g is not None:
+            return g, "store", time.time() - start
+    g = parse_ontology(ontology_path)
+    return g, "turtle", time.time() - start
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile a turtle ontology into a fast-loading store")
+    parser.add_argument("ontology_path")
+    parser.add_argument("--store_path", default=None)
+    args = parser.parse_args()
+
+    store_path = compile_ontology(args.ontology_path, args.store_path)
+    _, _, parse_time = load_graph(args.ontology_path, store_path, use_store=False)
+    g, source, store_time = load_graph(args.ontology_path, store_path)
+    print(f"Ontology store with {len(g)} triples saved to {store_path}")
+    print(f"Cold start: turtle {parse_time:.2f}s, {source} {store_time:.2f}s")
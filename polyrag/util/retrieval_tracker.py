@@ -1,20 +1,116 @@
 import json
 import os
 import time
+import uuid
+import atexit
+import builtins
+import threading
+from polyrag.util.tracing import tracer
+
+
+def dump_json_atomic(obj, path, indent=4, fsync=False):
+    # write to a temporary file and rename it over the target, a crash never leaves a partial file;
+    # `fsync` also makes the content durable against power loss before the rename
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=indent)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def new_id():
+    # readable timestamp plus a random suffix, ids made within the same second (e.g. micro-batches) stay unique
+    return f"{time.strftime('%Y-%m%d-%H:%M:%S', time.localtime())}-{uuid.uuid4().hex[:12]}"
+
+
+def iter_jsonl(path):
+    # stream the records of a JSONL file, a truncated last line from a crash is skipped
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
 
 class RetrievalTracker:
 
-    def __init__(self, tracker_path):
+    def __init__(self, tracker_path, flush_every=32, flush_interval=5.0, fsync=False):
+        # a .jsonl tracker is append-only: records are buffered and appended by size or time,
+        # any other path keeps the original single JSON list format
         self.tracker_path = tracker_path
+        self.jsonl = tracker_path.endswith(".jsonl")
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._buffer = []
+        self._last_flush = time.time()
+        # the buffer is flushed from the saving thread and from the timer thread
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        legacy_path = os.path.splitext(tracker_path)[0] + ".json"
         if os.path.exists(tracker_path):
-            self.tracker = json.load(open(tracker_path, "r"))
+            if self.jsonl:
+                self.tracker = list(iter_jsonl(tracker_path))
+            else:
+                self.tracker = json.load(open(tracker_path, "r"))
+        elif self.jsonl and os.path.exists(legacy_path):
+            # switching tracker_format to jsonl carries the history of the .json tracker over, it is left in place
+            self.tracker = json.load(open(legacy_path, "r"))
+            self.compact()
+            print(f"{len(self.tracker)} tracker records migrated from {legacy_path} to {tracker_path}")
         else:
             self.tracker = []
+        self._build_indexes()
+        if self.jsonl:
+            atexit.register(self.flush)
+            if flush_interval:
+                # records are also flushed by time when no new record is saved, e.g. in an idle service
+                threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            if self._buffer and time.time() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def close(self):
+        # stops the timer thread and writes the remaining records
+        self._closed.set()
+        self.flush()
+
+    def _build_indexes(self):
+        # record positions by id and by question, and success counters kept up to date on append
+        self._by_id = {}
+        self._by_question = {}
+        self._counts = {"s1": 0, "s2": 0, "s3": 0}
+        for i, t in enumerate(self.tracker):
+            self._index_record(i, t)
 
-    def update_tracker(self, question, s1_query_result, s2_retrieval_result, s2_agreement_result, s3_RAG_result, id=None, save=True):
+    def _index_record(self, i, t):
+        self._by_id.setdefault(t["id"], []).append(i)
+        self._by_question.setdefault(t["question"], []).append(i)
+        self._counts["s1"] += bool(t["s1_query_success"])
+        self._counts["s2"] += bool(t["s2_retrieval_success"])
+        self._counts["s3"] += t["success_round"] == 3
+
+    def update_tracker(self, question, s1_query_result, s2_retrieval_result, s2_agreement_result, s3_RAG_result, id=None, save=True,
+                       spans=None, s2_agreement_score=None):
         if id is None:
-            id = time.strftime("%Y-%m%d-%H:%M:%S", time.localtime())
+            id = new_id()
+        _t = self._make_record(question, s1_query_result, s2_retrieval_result, s2_agreement_result, s3_RAG_result, id,
+                               spans, s2_agreement_score)
+        self._append([_t])
+        if save:
+            self.save_tracker()
 
+    def _make_record(self, question, s1_query_result, s2_retrieval_result, s2_agreement_result, s3_RAG_result, id,
+                     spans=None, s2_agreement_score=None, allow_unresolved=False):
+        # with `allow_unresolved`, a question no stage answered gets a success_round 0 record with an "error"
         success_round = 0
         if s1_query_result:
             success_round = 1
@@ -23,7 +119,7 @@ class RetrievalTracker:
         elif s3_RAG_result:
             success_round = 3
         else:
-            assert False, "The PolyRAG retrieval pipeline is not completed"
+            assert allow_unresolved, "The PolyRAG retrieval pipeline is not completed"
 
         context = ""
         if success_round == 1:
@@ -44,40 +140,125 @@ class RetrievalTracker:
             "s2_retrieval_result": s2_retrieval_result,
             "s2_agreement_result": s2_agreement_result,
             "s2_retrieval_success": True if s2_agreement_result else False,
-            "s2_stage_context": ('\n').join(s2_retrieval_result),
+            "s2_stage_context": ('\n').join(s2_retrieval_result) if s2_retrieval_result else "",
             "s3_RAG_result": s3_RAG_result,
-            "s3_stage_context": ('\n').join(s3_RAG_result)
+            "s3_stage_context": ('\n').join(s3_RAG_result) if s3_RAG_result else ""
         }
-        self.tracker.append(_t)
+        # P(Yes) of the S2 agreement check when it is scored from the logits instead of generated
+        if s2_agreement_score is not None:
+            _t["s2_agreement_score"] = s2_agreement_score
+        # timing spans of the run that produced the record (see polyrag.util.tracing)
+        if spans is not None:
+            _t["spans"] = spans
+        if success_round == 0:
+            _t["error"] = "The PolyRAG retrieval pipeline is not completed"
+        return _t
+
+    def _append(self, records):
+        for _t in records:
+            self.tracker.append(_t)
+            self._index_record(len(self.tracker) - 1, _t)
+        if self.jsonl:
+            with self._lock:
+                self._buffer.extend(records)
+
+    def update_tracker_batch(self, questions, s1_query_results, s2_retrieval_results, s2_agreement_results, s3_RAG_results, ids=None, save=True,
+                             spans=None, s2_agreement_scores=None):
+        # same as update_tracker for many questions, saving the tracker once at the end. Every record is built
+        # before any is appended, and a question no stage answered is recorded as a failed (success_round 0)
+        # record instead of failing the batch. Returns the records in the order of `questions`.
+        # The spans of the batch are stored once, in its first record; every record has the batch_id to find them
+        batch_id = new_id()
+        if ids is None:
+            ids = [f"{batch_id}-{i}" for i in range(len(questions))]
+        records = [self._make_record(questions[i], s1_query_results[i], s2_retrieval_results[i], s2_agreement_results[i],
+                                     s3_RAG_results[i], ids[i], spans if i == 0 else None,
+                                     s2_agreement_scores[i] if s2_agreement_scores else None, allow_unresolved=True)
+                   for i in range(len(questions))]
+        for _t in records:
+            _t["batch_id"] = batch_id
+        self._append(records)
         if save:
             self.save_tracker()
+        return records
 
-    def save_tracker(self):
-        if os.path.exists(self.tracker_path):
-            os.remove(self.tracker_path)
-        with open(self.tracker_path, "w") as f:
-            json.dump(self.tracker, f, indent=4)
+    def save_tracker(self, force=False):
+        with tracer.span("tracker.save"):
+            self._save_tracker(force)
+
+    def _save_tracker(self, force=False):
+        if self.jsonl:
+            # only the records added since the last flush are written
+            if force or len(self._buffer) >= self.flush_every or time.time() - self._last_flush >= self.flush_interval:
+                self.flush()
+            return
+        dump_json_atomic(self.tracker, self.tracker_path, fsync=self.fsync)
         print(f"Tracker saved to {self.tracker_path}")
 
+    def flush(self):
+        with self._lock:
+            if not self._buffer:
+                self._last_flush = time.time()
+                return
+            os.makedirs(os.path.dirname(self.tracker_path) or ".", exist_ok=True)
+            with open(self.tracker_path, "a") as f:
+                f.write("".join(json.dumps(t) + "\n" for t in self._buffer))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            print(f"{len(self._buffer)} tracker records appended to {self.tracker_path}")
+            self._buffer = []
+            self._last_flush = time.time()
+
+    def compact(self):
+        # rewrite the JSONL file from the in-memory records, dropping partial lines left by crashes
+        with self._lock:
+            self._buffer = []
+            tmp_path = f"{self.tracker_path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write("".join(json.dumps(t) + "\n" for t in self.tracker))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.tracker_path)
+            self._last_flush = time.time()
+
+    def rotate(self, max_bytes=64 * 1024**2):
+        # move a JSONL file larger than max_bytes aside and start a new one, the in-memory records start over too
+        self.flush()
+        if not os.path.exists(self.tracker_path) or os.path.getsize(self.tracker_path) < max_bytes:
+            return None
+        root, ext = os.path.splitext(self.tracker_path)
+        rotated_path = f"{root}.{time.strftime('%Y%m%d-%H%M%S', time.localtime())}{ext}"
+        os.replace(self.tracker_path, rotated_path)
+        self.tracker = []
+        self._build_indexes()
+        return rotated_path
+
+    def export_json(self, json_path):
+        # the original single JSON list format
+        self.flush()
+        dump_json_atomic(self.tracker, json_path, fsync=True)
+        return json_path
+
     def _s1_stat(self, print=False):
-        s1_query_success = sum([t["s1_query_success"] for t in self.tracker])
+        s1_query_success = self._counts["s1"]
         s1_query_fail = len(self.tracker) - s1_query_success
         if print:
-            print(f"[S1 Ontology Query Results] Success: {s1_query_success}, Fail: {s1_query_fail}")
+            builtins.print(f"[S1 Ontology Query Results] Success: {s1_query_success}, Fail: {s1_query_fail}")
         return s1_query_success, s1_query_fail
 
     def _s2_stat(self, print=False):
-        s2_retrieval_success = sum([t["s2_retrieval_success"] for t in self.tracker])
+        s2_retrieval_success = self._counts["s2"]
         s2_retrieval_fail = len(self.tracker) - s2_retrieval_success
         if print:
-            print(f"[S2 Retrieval Agreement Results] Success: {s2_retrieval_success}, Fail: {s2_retrieval_fail}")
+            builtins.print(f"[S2 Retrieval Agreement Results] Success: {s2_retrieval_success}, Fail: {s2_retrieval_fail}")
         return s2_retrieval_success, s2_retrieval_fail
     
     def _s3_stat(self, print=False):
-        s3_RAG_success = sum([t["success_round"]==3 for t in self.tracker])
+        s3_RAG_success = self._counts["s3"]
         s3_RAG_fail = len(self.tracker) - s3_RAG_success
         if print:
-            print(f"[PolyRAG Results] Success: {s3_RAG_success}, Fail: {s3_RAG_fail}")
+            builtins.print(f"[PolyRAG Results] Success: {s3_RAG_success}, Fail: {s3_RAG_fail}")
         return s3_RAG_success, s3_RAG_fail
 
     def print_statistics(self):
@@ -87,9 +268,9 @@ class RetrievalTracker:
 
     def get_contexts(self, question=None, id=None):
         if question:
-            return [t["context"] for t in self.tracker if t["question"]==question]
+            return [self.tracker[i]["context"] for i in self._by_question.get(question, [])]
         elif id:
-            return [t["context"] for t in self.tracker if t["id"]==id]
+            return [self.tracker[i]["context"] for i in self._by_id.get(id, [])]
         else:
             assert False, "At least one of question and id should be provided"
 
@@ -124,20 +305,40 @@ class RetrievalTrackerTest:
                                  "s2_stage_context": "",
                                  "s3_RAG_result": None,
                                  "s3_stage_context": ""})
+        self._build_indexes()
+
+    def _build_indexes(self):
+        # position of each id, and success counters updated whenever a flag changes through _set
+        self._index = {id: i for i, id in enumerate(self.ids)}
+        self._counts = {"s1": 0, "s2": 0, "s2_after_s1_fail": 0}
+        for t in self.tracker:
+            for k, v in self._contribution(t).items():
+                self._counts[k] += v
+
+    @staticmethod
+    def _contribution(t):
+        return {"s1": bool(t["s1_query_success"]),
+                "s2": bool(t["s2_retrieval_success"]),
+                "s2_after_s1_fail": bool(t["s2_retrieval_success"]) and not t["s1_query_success"]}
+
+    def _set(self, i, **fields):
+        t = self.tracker[i]
+        before = self._contribution(t)
+        t.update(fields)
+        for k, v in self._contribution(t).items():
+            self._counts[k] += v - before[k]
             
     def save_tracker(self):
-        if os.path.exists(self.tracker_path):
-            os.remove(self.tracker_path)
-        with open(self.tracker_path, "w") as f:
-            json.dump(self.tracker, f, indent=4)
+        dump_json_atomic(self.tracker, self.tracker_path)
         print(f"Tracker saved to {self.tracker_path.split('/')[-1]}")
 
     def load_tracker(self, tracker_path):
         self.tracker_path = tracker_path
         self.tracker = json.load(open(tracker_path, "r"))
+        self._build_indexes()
 
     def get_questions_by_ids(self, ids):
-        ids_index = [self.ids.index(i) for i in ids]
+        ids_index = [self._index[i] for i in ids]
         return [self.questions[i] for i in ids_index]
             
     def update_s1_query_result(self, query_results: list):
@@ -145,14 +346,14 @@ class RetrievalTrackerTest:
             raise ValueError("Length of query results does not match the length of tracker")
         for i in range(len(self.tracker)):
             self.tracker[i]["s1_query_result"] = query_results[i]
-            self.tracker[i]["s1_query_success"] = True if query_results[i] else False
+            self._set(i, s1_query_success=True if query_results[i] else False)
             if self.tracker[i]["s1_query_success"]:
                 self.tracker[i]["context"] = f"{self.tracker[i]['question']} {query_results[i]}"
                 self.tracker[i]["success_round"] = 1
         return self.tracker
 
     def print_s1_query_statistics(self):
-        s1_query_success = sum([t["s1_query_success"] for t in self.tracker])
+        s1_query_success = self._counts["s1"]
         s1_query_fail = len(self.tracker) - s1_query_success
         print(f"[S1 Ontology Query Results] Success: {s1_query_success}, Fail: {s1_query_fail}")
     
@@ -164,7 +365,7 @@ class RetrievalTrackerTest:
     def update_s2_retrieval_result(self, retrieval_results: list):
         if len(retrieval_results) != len(self.s2_retrieval_ids):
             raise ValueError("Length of retrieval results does not match the length of tracker")
-        id_alignment = [self.ids.index(i) for i in self.s2_retrieval_ids]
+        id_alignment = [self._index[i] for i in self.s2_retrieval_ids]
         for i in range(len(self.s2_retrieval_ids)):
             self.tracker[id_alignment[i]]["s2_retrieval_result"] = retrieval_results[i]
         
@@ -173,23 +374,23 @@ class RetrievalTrackerTest:
         return "Yes" in retrieval_result
     
     def update_s2_agreement_result(self, agreement_results: list):
-        id_alignment = [self.ids.index(i) for i in self.s2_retrieval_ids]
+        id_alignment = [self._index[i] for i in self.s2_retrieval_ids]
         for i in range(len(agreement_results)):
             self.tracker[id_alignment[i]]["s2_agreement_result"] = agreement_results[i]
             self.tracker[id_alignment[i]]["context"] = ('\n').join(self.tracker[id_alignment[i]]["s2_retrieval_result"])
             if self.check_s2_agreement(agreement_results[i]):
-                self.tracker[id_alignment[i]]["s2_retrieval_success"] = True
+                self._set(id_alignment[i], s2_retrieval_success=True)
                 self.tracker[id_alignment[i]]["success_round"] = 2
             else:
-                self.tracker[id_alignment[i]]["s2_retrieval_success"] = False
+                self._set(id_alignment[i], s2_retrieval_success=False)
 
     def print_s2_retrieval_statistics(self):
-        s2_retrieval_success = sum([t["s2_retrieval_success"] for t in self.tracker if not t["s1_query_success"]])
+        s2_retrieval_success = self._counts["s2_after_s1_fail"]
         s2_retrieval_fail = len(self.s2_retrieval_ids) - s2_retrieval_success
         print(f"[S2 Retrieval Agreement Results] Success: {s2_retrieval_success}, Fail: {s2_retrieval_fail}")
 
     def stage_wise_print_s2_retrieval_statistics(self):
-        s2_retrieval_success = sum([t["s2_retrieval_success"] for t in self.tracker])
+        s2_retrieval_success = self._counts["s2"]
         s2_retrieval_fail = len(self.tracker) - s2_retrieval_success
         print(f"[S2 Retrieval Agreement Results] Success: {s2_retrieval_success}, Fail: {s2_retrieval_fail}")
 
@@ -201,7 +402,7 @@ class RetrievalTrackerTest:
     def update_s3_RAG_result(self, RAG_results: list):
         if len(RAG_results) != len(self.s3_RAG_ids):
             raise ValueError("Length of RAG results does not match the length of tracker")
-        id_alignment = [self.ids.index(i) for i in self.s3_RAG_ids]
+        id_alignment = [self._index[i] for i in self.s3_RAG_ids]
         for i in range(len(self.s3_RAG_ids)):
             self.tracker[id_alignment[i]]["s3_RAG_result"] = RAG_results[i]
             self.tracker[id_alignment[i]]["success_round"] = 3
@@ -221,7 +422,7 @@ class RetrievalTrackerTest:
             raise ValueError("Length of query results does not match the length of tracker")
         for i in range(len(self.tracker)):
             self.tracker[i]["s1_query_result"] = query_results[i]
-            self.tracker[i]["s1_query_success"] = True if query_results[i] else False
+            self._set(i, s1_query_success=True if query_results[i] else False)
             if self.tracker[i]["s1_query_success"]:
                 self.tracker[i]["s1_stage_context"] = f"{self.tracker[i]['question']} {query_results[i]}"
             else:
@@ -247,9 +448,9 @@ class RetrievalTrackerTest:
         for i in range(len(self.tracker)):
             self.tracker[i]["s2_agreement_result"] = agreement_results[i]
             if self.check_s2_agreement(agreement_results[i]):
-                self.tracker[i]["s2_retrieval_success"] = True
+                self._set(i, s2_retrieval_success=True)
             else:
-                self.tracker[i]["s2_retrieval_success"] = False
+                self._set(i, s2_retrieval_success=False)
 
     def stage_wise_update_s3_RAG_result(self, RAG_results: list):
         assert self.stage_wise == True, "Stage-wise update is not enabled"
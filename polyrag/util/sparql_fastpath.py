@@ -0,0 +1,175 @@
+import re
+from rdflib import URIRef, Variable
+from rdflib.namespace import RDF
+from polyrag.util.literal_index import LiteralIndex, is_string_literal
+
+# FILTER (contains(lcase(?var), lcase("needle"))), the needle may also be given without lcase
+FILTER_RE = re.compile(
+    r'FILTER\s*\(\s*contains\s*\(\s*lcase\s*\(\s*\?(\w+)\s*\)\s*,\s*(lcase\s*\(\s*)?"([^"\\]*)"\s*(\))?\s*\)\s*\)',
+    re.IGNORECASE)
+QUERY_RE = re.compile(r'^\s*SELECT\s+((?:\?\w+\s*)+)WHERE\s*\{(.*)\}\s*$', re.IGNORECASE | re.DOTALL)
+TOKEN_RE = re.compile(r'\?\w+|<[^<>"\s]*>|[A-Za-z][\w-]*:[\w-]*|\S+')
+
+
+class SparqlFastPath:
+    """
+    Answers the SELECT shapes used by the S1 few-shot templates (basic graph patterns with
+    constant predicates and FILTER contains(lcase(?x), lcase("..."))) from per-predicate
+    subject->objects and object->subjects maps instead of rdflib's generic evaluation.
+    `execute` returns None for anything it does not recognize, the caller then uses rdflib.
+    """
+
+    def __init__(self, graph, namespaces=None, literal_index=None):
+        self.prefixes = {prefix: str(ns) for prefix, ns in graph.namespaces()}
+        self.prefixes.update({prefix: str(ns) for prefix, ns in (namespaces or {}).items()})
+        self.po = {}
+        self.op = {}
+        self.sizes = {}
+        for s, p, o in graph:
+            self.po.setdefault(p, {}).setdefault(s, []).append(o)
+            self.op.setdefault(p, {}).setdefault(o, []).append(s)
+            self.sizes[p] = self.sizes.get(p, 0) + 1
+        # contains filters on literal objects are answered from the trigram index
+        self.literal_index = literal_index if literal_index is not None else LiteralIndex.build(graph)
+        self.hits = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def is_string(term):
+        # lcase/contains only accept simple or xsd:string literals, anything else is a filter error
+        return is_string_literal(term)
+
+    def _term(self, token):
+        if token.startswith("?"):
+            return Variable(token[1:])
+        if token == "a":
+            return RDF.type
+        if token.startswith("<") and token.endswith(">"):
+            return URIRef(token[1:-1])
+        if ":" in token:
+            prefix, local = token.split(":", 1)
+            if prefix in self.prefixes:
+                return URIRef(self.prefixes[prefix] + local)
+        return None
+
+    def parse(self, query):
+        # returns (projection, patterns, filters) or None if the query is not a supported shape
+        match = QUERY_RE.match(query)
+        if match is None:
+            return None
+        projection = [Variable(v) for v in re.findall(r'\?(\w+)', match.group(1))]
+        body = match.group(2)
+
+        filters = {}
+        for var, lcase_open, needle, lcase_close in FILTER_RE.findall(body):
+            if bool(lcase_open) != bool(lcase_close):
+                return None
+            filters.setdefault(Variable(var), []).append(needle.lower() if lcase_open else needle)
+        body = FILTER_RE.sub(" . ", body)
+
+        patterns = []
+        terms = []
+        for token in TOKEN_RE.findall(body) + ["."]:
+            if token == ".":
+                if len(terms) == 3:
+                    patterns.append(tuple(terms))
+                elif terms:
+                    return None
+                terms = []
+                continue
+            term = self._term(token)
+            if term is None or len(terms) == 3:
+                return None
+            terms.append(term)
+
+        if not patterns or any(isinstance(p, Variable) for _, p, _ in patterns):
+            return None
+        bound = {t for pattern in patterns for t in pattern if isinstance(t, Variable)}
+        if not set(projection) <= bound or not set(filters) <= bound:
+            return None
+        return projection, patterns, filters
+
+    def _passes(self, value, needles):
+        return self.is_string(value) and all(n in str(value).lower() for n in needles)
+
+    def _filtered_objects(self, p, needles):
+        # the literal objects of `p` passing the contains filters, from the trigram index
+        literals = self.literal_index.literals.get(p, [])
+        objects = [literals[i] for i in self.literal_index.candidates(p, needles[0])]
+        return [obj for obj in objects if self._passes(obj, needles[1:])]
+
+    def _matches(self, pattern, binding, filters, scans):
+        s, p, o = (binding.get(t, t) if isinstance(t, Variable) else t for t in pattern)
+        s_var = s if isinstance(s, Variable) else None
+        o_var = o if isinstance(o, Variable) else None
+        po = self.po.get(p, {})
+        if s_var is None and o_var is None:
+            if o in po.get(s, ()):
+                yield binding
+        elif o_var is None:
+            for subject in self.op.get(p, {}).get(o, ()):
+                yield {**binding, s_var: subject}
+        elif s_var is None:
+            for obj in po.get(s, ()):
+                if o_var not in filters or self._passes(obj, filters[o_var]):
+                    yield {**binding, o_var: obj}
+        else:
+            if o_var in filters:
+                objects = scans[pattern]
+            else:
+                objects = self.op.get(p, {})
+            for obj in objects:
+                for subject in self.op[p][obj]:
+                    if s_var == o_var and subject != obj:
+                        continue
+                    if s_var in filters and not self._passes(subject, filters[s_var]):
+                        continue
+                    yield {**binding, s_var: subject, o_var: obj}
+
+    def _cost(self, pattern, binding, filters, scans):
+        # join order: the pattern with the fewest expected rows first, a bound object such as
+        # `?dept rdf:type base:DEPARTMENT` can fan out to more rows than a filtered name lookup
+        s, p, o = (binding.get(t, t) if isinstance(t, Variable) else t for t in pattern)
+        s_bound = not isinstance(s, Variable)
+        o_bound = not isinstance(o, Variable)
+        if s_bound and o_bound:
+            return 0
+        if s_bound:
+            return len(self.po.get(p, {}).get(s, ()))
+        if o_bound:
+            return len(self.op.get(p, {}).get(o, ()))
+        if o in filters:
+            return sum(len(self.op[p][obj]) for obj in scans[pattern])
+        return self.sizes.get(p, 0)
+
+    def _solve(self, patterns, binding, filters, scans):
+        if not patterns:
+            yield binding
+            return
+        i = min(range(len(patterns)), key=lambda j: self._cost(patterns[j], binding, filters, scans))
+        rest = patterns[:i] + patterns[i + 1:]
+        for b in self._matches(patterns[i], binding, filters, scans):
+            yield from self._solve(rest, b, filters, scans)
+
+    def execute(self, query, limit=None):
+        """
+        Returns the projected rows as tuples of rdflib terms, at most `limit` of them,
+        or None if the query shape is not supported.
+        """
+        parsed = self.parse(query) if query else None
+        if parsed is None:
+            self.fallbacks += 1
+            return None
+        self.hits += 1
+        projection, patterns, filters = parsed
+        # the filtered scans are looked up once per query, both to order the joins and to run them
+        scans = {pattern: self._filtered_objects(pattern[1], filters[pattern[2]]) for pattern in patterns
+                 if isinstance(pattern[2], Variable) and pattern[2] in filters}
+        rows = []
+        for binding in self._solve(list(patterns), {}, filters, scans):
+            # filters on variables bound by a fully bound pattern are checked here
+            if all(self._passes(binding[v], needles) for v, needles in filters.items()):
+                rows.append(tuple(binding[v] for v in projection))
+                if limit is not None and len(rows) >= limit:
+                    break
+        return rows
@@ -228,4 +228,14 @@ Context:
 '''
 Question: {question}
 {choices}
-Answer: """
\ No newline at end of file
+Answer: """
+
+FINAL_ANSWER = """You are a smart assistant who knows everything about PolyU. Given a question and a context, you should be able to answer the question based on the context.
+
+The context is as follows:
+{context}
+
+The question is:
+{question}
+
+Please answer the question."""
\ No newline at end of file
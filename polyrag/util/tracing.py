@@ -0,0 +1,137 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# latency histogram buckets in seconds, as in Prometheus client defaults
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# numeric span attributes that are summed into counters, e.g. polyrag_prompt_tokens_total,
+# decode_budget is the max_new_tokens a generate call was allowed (output_tokens are the steps it ran)
+COUNTED = ("prompt_tokens", "output_tokens", "decode_budget")
+
+
+class Trace:
+    # the spans of one question (run_llm) or one batch (run_batch), in the order they finished
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []
+
+
+class Metrics:
+    """
+    Per span name: call count, total seconds, latency histogram, cache hits/misses (spans with a
+    `cache_hit` attribute) and token counters. Rendered as Prometheus text or as a dict for JSON.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = {}
+
+    def observe(self, name, seconds, attrs):
+        with self._lock:
+            m = self.spans.get(name)
+            if m is None:
+                m = self.spans[name] = {"count": 0, "seconds": 0.0, "buckets": [0] * len(BUCKETS),
+                                        "cache_hits": 0, "cache_misses": 0, **{k: 0 for k in COUNTED}}
+            m["count"] += 1
+            m["seconds"] += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    m["buckets"][i] += 1
+            if "cache_hit" in attrs:
+                m["cache_hits" if attrs["cache_hit"] else "cache_misses"] += 1
+            for key in COUNTED:
+                m[key] += attrs.get(key) or 0
+
+    def clear(self):
+        with self._lock:
+            self.spans = {}
+
+    def to_dict(self):
+        with self._lock:
+            return {name: {"count": m["count"], "seconds": m["seconds"],
+                           "mean_ms": m["seconds"] / m["count"] * 1000, "cache_hits": m["cache_hits"],
+                           "cache_misses": m["cache_misses"], **{k: m[k] for k in COUNTED}}
+                    for name, m in self.spans.items()}
+
+    def prometheus_text(self, extra=None):
+        # `extra` is {metric name: value} for gauges/counters kept elsewhere (e.g. service stats)
+        lines = ["# TYPE polyrag_span_seconds histogram"]
+        with self._lock:
+            spans = {name: dict(m, buckets=list(m["buckets"])) for name, m in self.spans.items()}
+        for name, m in spans.items():
+            for bound, count in zip(BUCKETS, m["buckets"]):
+                lines.append(f'polyrag_span_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+            lines.append(f'polyrag_span_seconds_bucket{{span="{name}",le="+Inf"}} {m["count"]}')
+            lines.append(f'polyrag_span_seconds_sum{{span="{name}"}} {m["seconds"]}')
+            lines.append(f'polyrag_span_seconds_count{{span="{name}"}} {m["count"]}')
+        for metric, key in (("polyrag_cache_hits_total", "cache_hits"), ("polyrag_cache_misses_total", "cache_misses"),
+                            *((f"polyrag_{k}_total", k) for k in COUNTED)):
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f'{metric}{{span="{name}"}} {m[key]}' for name, m in spans.items() if m[key])
+        for metric, value in (extra or {}).items():
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Tracer:
+    """
+    Spans for the waterfall stages and their sub-steps. `with tracer.span("s1.generate") as span:`
+    times the block, `span` is a dict of attributes the block can fill in (token counts, cache_hit, ...).
+    Every span is aggregated into `metrics`; inside `with tracer.trace("run_llm") as trace:` it is also
+    appended to trace.spans as {"name", "parent", "start_ms", "duration_ms", **attrs}. The current trace
+    and the stack of open spans are per thread, `attach` carries the trace into a worker thread.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.metrics = Metrics()
+        self._local = threading.local()
+
+    @property
+    def current(self):
+        return getattr(self._local, "trace", None)
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def attach(self, trace):
+        previous = self.current
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+
+    @contextmanager
+    def trace(self, name):
+        with self.attach(Trace(name)) as trace:
+            with self.span(name):
+                yield trace
+
+    @contextmanager
+    def span(self, name, **attrs):
+        if not self.enabled:
+            yield attrs
+            return
+        trace = self.current
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            if trace is not None:
+                trace.spans.append({"name": name, "parent": parent, "start_ms": (start - trace.start) * 1000,
+                                    "duration_ms": duration * 1000, **attrs})
+            self.metrics.observe(name, duration, attrs)
+
+
+# the process-wide tracer used by the pipeline components
+tracer = Tracer()
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import argparse
+from array import array
+import numpy as np
+from polyrag.util.retrieval_tracker import iter_jsonl
+
+# tracker ids start with the local time the record was added ("%Y-%m%d-%H:%M:%S"), batch ids append "-<i>"
+_day_cache = {}
+
+
+def parse_id_time(id):
+    # wall-clock seconds since 1970-01-01 (the id carries no timezone), or -1 when the id does not start
+    # with a timestamp; only the date part goes through numpy, once per distinct day
+    id = str(id)
+    try:
+        day = _day_cache.get(id[:9])
+        if day is None:
+            day = int(np.datetime64(f"{id[:4]}-{id[5:7]}-{id[7:9]}", "s").astype(np.int64))
+            _day_cache[id[:9]] = day
+        if id[9] != "-" or id[12] != ":" or id[15] != ":":
+            return -1
+        return day + int(id[10:12]) * 3600 + int(id[13:15]) * 60 + int(id[16:18])
+    except (ValueError, IndexError):
+        return -1
+
+
+def iter_tracker_file(path):
+    if path.endswith(".jsonl"):
+        return iter_jsonl(path)
+    return iter(json.load(open(path, "r")))
+
+
+class TrackerColumns:
+    """
+    Columnar view of RetrievalTracker records for analytics over long histories.
+    One NumPy array per field: success round (int8), S1/S2 success flags (bool), time
+    (datetime64[s], NaT when the id carries no timestamp) and question id (int32) into an
+    interned question table. Contexts and stage outputs are not kept. Filters return a new
+    TrackerColumns sharing the question table, aggregations are bincounts over the arrays.
+    """
+
+    def __init__(self, success_round, s1_success, s2_success, timestamps, question_ids, questions):
+        self.success_round = success_round
+        self.s1_success = s1_success
+        self.s2_success = s2_success
+        self.timestamps = timestamps
+        self.question_ids = question_ids
+        self.questions = questions
+
+    @classmethod
+    def from_records(cls, records):
+        # records are consumed one at a time into compact typed buffers, so a JSONL file is never
+        # materialized as a list of dicts
+        success_round = array("b")
+        s1_success = array("b")
+        s2_success = array("b")
+        seconds = array("q")
+        question_ids = array("i")
+        vocab = {}
+        for t in records:
+            success_round.append(t["success_round"])
+            s1_success.append(bool(t["s1_query_success"]))
+            s2_success.append(bool(t["s2_retrieval_success"]))
+            seconds.append(parse_id_time(t["id"]))
+            question_ids.append(vocab.setdefault(t["question"], len(vocab)))
+        seconds = np.frombuffer(seconds, dtype=np.int64)
+        timestamps = seconds.astype("datetime64[s]")
+        timestamps[seconds < 0] = np.datetime64("NaT")
+        return cls(np.frombuffer(success_round, dtype=np.int8),
+                   np.frombuffer(s1_success, dtype=np.int8).astype(bool),
+                   np.frombuffer(s2_success, dtype=np.int8).astype(bool),
+                   timestamps,
+                   np.frombuffer(question_ids, dtype=np.int32),
+                   list(vocab))
+
+    @classmethod
+    def from_tracker(cls, tracker):
+        return cls.from_records(tracker.tracker)
+
+    @classmethod
+    def from_files(cls, paths):
+        # several tracker files (e.g. rotated JSONL files) as one history
+        return cls.from_records(t for path in paths for t in iter_tracker_file(path))
+
+    def save(self, path):
+        # questions are stored as one UTF-8 buffer plus offsets, so loading needs no pickle
+        encoded = [q.encode("utf-8") for q in self.questions]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(q) for q in encoded], out=offsets[1:])
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, success_round=self.success_round, s1_success=self.s1_success, s2_success=self.s2_success,
+                     timestamps=self.timestamps, question_ids=self.question_ids,
+                     question_offsets=offsets, question_bytes=np.frombuffer(b"".join(encoded), dtype=np.uint8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        offsets = data["question_offsets"]
+        buffer = data["question_bytes"].tobytes()
+        questions = [buffer[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+        return cls(data["success_round"], data["s1_success"], data["s2_success"], data["timestamps"],
+                   data["question_ids"], questions)
+
+    def __len__(self):
+        return len(self.success_round)
+
+    def filter(self, mask):
+        return TrackerColumns(self.success_round[mask], self.s1_success[mask], self.s2_success[mask],
+                              self.timestamps[mask], self.question_ids[mask], self.questions)
+
+    def between(self, start=None, end=None):
+        # records with start <= time < end, bounds are anything np.datetime64 accepts ("2024-05-01", ...)
+        mask = ~np.isnat(self.timestamps)
+        if start is not None:
+            mask &= self.timestamps >= np.datetime64(start, "s")
+        if end is not None:
+            mask &= self.timestamps < np.datetime64(end, "s")
+        return self.filter(mask)
+
+    def with_round(self, success_round):
+        return self.filter(self.success_round == success_round)
+
+    def question_mask(self, question):
+        if question not in self.questions:
+            return np.zeros(len(self), dtype=bool)
+        return self.question_ids == self.questions.index(question)
+
+    def round_counts(self):
+        # number of records answered at each round, index 0 is unanswered
+        return np.bincount(self.success_round, minlength=4)
+
+    def _s1_stat(self):
+        s1_query_success = int(np.count_nonzero(self.s1_success))
+        return s1_query_success, len(self) - s1_query_success
+
+    def _s2_stat(self):
+        s2_retrieval_success = int(np.count_nonzero(self.s2_success))
+        return s2_retrieval_success, len(self) - s2_retrieval_success
+
+    def _s3_stat(self):
+        s3_RAG_success = int(self.round_counts()[3])
+        return s3_RAG_success, len(self) - s3_RAG_success
+
+    def print_statistics(self):
+        # same output as RetrievalTracker.print_statistics
+        print("[S1 Ontology Query Results] Success: {}, Fail: {}".format(*self._s1_stat()))
+        print("[S2 Retrieval Agreement Results] Success: {}, Fail: {}".format(*self._s2_stat()))
+        print("[PolyRAG Results] Success: {}, Fail: {}".format(*self._s3_stat()))
+
+    def rate_by_period(self, flag="s2", period="W"):
+        """
+        Success rate of a stage per calendar period (a datetime64 unit: "D", "W", "M", ...), weeks start on Monday.
+        `flag` is "s1" or "s2" for the stage success flags, or a success round 1-3.
+        Returns a list of (period start, records, successes, rate); records without a time are skipped.
+        """
+        if flag in ("s1", "s2"):
+            hits = self.s1_success if flag == "s1" else self.s2_success
+        else:
+            hits = self.success_round == flag
+        known = ~np.isnat(self.timestamps)
+        timestamps = self.timestamps[known]
+        if period == "W":
+            # numpy weeks start on Thursday (1970-01-01), shift so they start on Monday
+            shift = np.timedelta64(3, "D")
+            periods, inverse = np.unique((timestamps + shift).astype("datetime64[W]"), return_inverse=True)
+            periods = periods.astype("datetime64[D]") - shift
+        else:
+            periods, inverse = np.unique(timestamps.astype(f"datetime64[{period}]"), return_inverse=True)
+        totals = np.bincount(inverse, minlength=len(periods))
+        successes = np.bincount(inverse, weights=hits[known], minlength=len(periods)).astype(np.int64)
+        return [(str(p), int(n), int(s), float(s / n)) for p, n, s in zip(periods, totals, successes)]
+
+    def top_questions(self, n=20, success_round=None):
+        # most frequent questions, e.g. success_round=3 for the questions that fall through to S3
+        ids = self.question_ids if success_round is None else self.question_ids[self.success_round == success_round]
+        counts = np.bincount(ids, minlength=len(self.questions))
+        top = np.argsort(-counts, kind="stable")[:n]
+        return [(self.questions[i], int(counts[i])) for i in top if counts[i] > 0]
+
+
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Columnar statistics over tracker files")
+    parser.add_argument("tracker_paths", nargs="+", help="tracker .json/.jsonl files or a saved .npz")
+    parser.add_argument("--save", default=None, help="write the columns to this .npz")
+    parser.add_argument("--period", default="W")
+    parser.add_argument("--start", default=None)
+    parser.add_argument("--end", default=None)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    start = time.time()
+    if len(args.tracker_paths) == 1 and args.tracker_paths[0].endswith(".npz"):
+        columns = TrackerColumns.load(args.tracker_paths[0])
+    else:
+        columns = TrackerColumns.from_files(args.tracker_paths)
+    print(f"{len(columns)} records, {len(columns.questions)} distinct questions loaded in {time.time() - start:.2f}s")
+    if args.save:
+        columns.save(args.save)
+    if args.start or args.end:
+        columns = columns.between(args.start, args.end)
+
+    columns.print_statistics()
+    print(f"S2 agreement rate per {args.period}:")
+    for p, n, s, rate in columns.rate_by_period("s2", args.period):
+        print(f"  {p}: {s}/{n} ({rate:.1%})")
+    print("Questions falling through to S3:")
+    for question, count in columns.top_questions(args.top, success_round=3):
+        print(f"  {count:6d}  {question}")
@@ -0,0 +1,83 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("accelerate")
+
+import polyrag.util.templates as tp
+from polyrag.model.PolyRAG import static_prefix
+
+SPECIALS = ["<|begin_of_text|>", "<|eot_id|>", "<|start_header_id|>", "<|end_header_id|>"]
+QUESTIONS = ["What department does Cao Jiannong work for?", "Who works for AMA?",
+             "What is/are the research interests of Cao Jiannong and which department does he work for?"]
+# top_p keeps at least one token, a tiny value makes sampling greedy so outputs can be compared
+GREEDY = dict(temperature=1.0, top_p=1e-9)
+
+
+@pytest.fixture(scope="module")
+def llm(tmp_path_factory):
+    # random 2-layer Llama with a BPE tokenizer trained on the templates, small enough for CPU
+    from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders
+    from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+    from polyrag.model.llm import Llama3
+    model_dir = str(tmp_path_factory.mktemp("tiny_llama"))
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    corpus = [tp.S1_QUERY_V2_4_SHOTS, tp.S2_AGREEMENT_2_SHOTS, "Yes No yes no"] * 20
+    tokenizer.train_from_iterator(corpus, trainers.BpeTrainer(vocab_size=500, special_tokens=SPECIALS,
+                                                              initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token=SPECIALS[0], eos_token=SPECIALS[1])
+    tokenizer.save_pretrained(model_dir)
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096,
+                         bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id)
+    LlamaForCausalLM(config).save_pretrained(model_dir)
+    model = Llama3(model_dir)
+    model.model.float()
+    return model
+
+
+def s1_prompt(question):
+    return tp.S1_QUERY_V2_4_SHOTS.format(question=question)
+
+
+def s2_prompt(question):
+    return tp.S2_AGREEMENT_2_SHOTS.format(question=question, information="Cao Jiannong works for COMP.")
+
+
+def test_generate_with_prefix(llm):
+    prefix = static_prefix(tp.S1_QUERY_V2_4_SHOTS)
+    # the last prompt only shares the system header with the prefix, its cached KV is cropped
+    for prompt in [s1_prompt(q) for q in QUESTIONS] + [s2_prompt(QUESTIONS[0])]:
+        expected, _ = llm.generate(prompt, max_new_tokens=12, **GREEDY)
+        response, _ = llm.generate(prompt, max_new_tokens=12, prefix=prefix, **GREEDY)
+        assert response == expected
+    assert llm.prefix_cache.hits >= len(QUESTIONS) - 1
+
+
+def test_generate_batch_with_prefix(llm):
+    prefix = static_prefix(tp.S1_QUERY_V2_4_SHOTS)
+    prompts = [s1_prompt(q) for q in QUESTIONS]
+    expected = llm.generate_batch(prompts, max_new_tokens=12, **GREEDY)
+    responses = llm.generate_batch(prompts, max_new_tokens=12, prefix=prefix, **GREEDY)
+    assert [r for r, _ in responses] == [r for r, _ in expected]
+    # the batch and the single prompt decode the same tokens
+    assert responses[0][0] == llm.generate(prompts[0], max_new_tokens=12, **GREEDY)[0]
+    mixed = prompts[:2] + [s2_prompt(QUESTIONS[0])]
+    expected = llm.generate_batch(mixed, max_new_tokens=12, **GREEDY)
+    assert llm.generate_batch(mixed, max_new_tokens=12, prefix=prefix, **GREEDY) == expected
+
+
+def test_score_yes_no_with_prefix(llm):
+    prefix = static_prefix(tp.S2_AGREEMENT_2_SHOTS)
+    prompts = [s2_prompt(q) for q in QUESTIONS]
+    expected = [llm.score_yes_no(p) for p in prompts]
+    assert [llm.score_yes_no(p, prefix=prefix) for p in prompts] == pytest.approx(expected, abs=1e-5)
+    assert llm.score_yes_no_batch(prompts) == pytest.approx(expected, abs=1e-5)
+    assert llm.score_yes_no_batch(prompts, prefix=prefix) == pytest.approx(expected, abs=1e-5)
+    # a prefix the prompts only partly share
+    other = static_prefix(tp.S1_QUERY_V2_4_SHOTS)
+    assert llm.score_yes_no_batch(prompts, prefix=other) == pytest.approx(expected, abs=1e-5)
+    assert llm.score_yes_no(prompts[0], prefix=other) == pytest.approx(expected[0], abs=1e-5)
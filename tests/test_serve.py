@@ -0,0 +1,122 @@
+import json
+import asyncio
+import threading
+import pytest
+
+from polyrag.benchmark import synthetic_triples, write_search_data, quiet
+from polyrag.model.PolyRAG import PolyRAG
+from polyrag.model.stub import StubLLM, StubEncoder
+from polyrag.serve import PolyRAGService
+
+QUESTIONS = [f"Which topics does Staff {i} work on?" for i in range(8)]
+
+
+class GatedLLM(StubLLM):
+    # StubLLM whose batches wait for `gate` and fail on questions containing "boom"
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.batch_sizes = []
+
+    def generate_batch(self, texts, **kwargs):
+        self.gate.wait()
+        self.batch_sizes.append(len(texts))
+        if any("boom" in text for text in texts):
+            raise ValueError("boom")
+        return super().generate_batch(texts, **kwargs)
+
+
+@pytest.fixture
+def poly(tmp_path):
+    # S2 and S3 over small synthetic data, the ontology (S1) is not needed
+    encoder = StubEncoder(dim=32)
+    kg = synthetic_triples(200)
+    kg_path, kg_embed_path = write_search_data(str(tmp_path), "kg", kg, encoder, stage=2)
+    chunks = [{"text": ". ".join(f"{x['sub']} {x['rel']} {x['obj']}" for x in kg[i:i + 8])} for i in range(0, len(kg), 8)]
+    rag_path, rag_embed_path = write_search_data(str(tmp_path), "corpus", chunks, encoder, stage=3)
+    config = json.load(open("config.json", "r"))
+    config.update(poly="s2s3", tracker_dir=str(tmp_path), kg_path=kg_path, kg_embed_path=kg_embed_path, rag_path=rag_path,
+                  rag_embed_path=rag_embed_path, s2_retrieval="dense", s3_retrieval="dense", query_cache_path=None)
+    with quiet():
+        poly = PolyRAG(config, encoder=encoder)
+        poly.warmup()
+    return poly
+
+
+def run(coroutine):
+    with quiet():
+        return asyncio.run(coroutine)
+
+
+def test_requests_are_batched(poly):
+    async def main():
+        service = PolyRAGService(poly, llm, max_batch_size=4, max_wait_ms=50)
+        await service.start()
+        try:
+            return await asyncio.gather(*(service.answer(q) for q in QUESTIONS)), service.stats
+        finally:
+            await service.stop()
+
+    llm = GatedLLM()
+    records, stats = run(main())
+    assert [r["question"] for r in records] == QUESTIONS
+    assert all(r["success_round"] == 3 for r in records)
+    assert stats["batches"] == 2 and stats["max_batch_size"] == 4
+    assert llm.batch_sizes == [4, 4]
+
+
+def test_full_queue_applies_backpressure(poly):
+    async def main():
+        service = PolyRAGService(poly, llm, max_batch_size=1, max_wait_ms=0, max_queue_size=2)
+        await service.start()
+        try:
+            tasks = [asyncio.create_task(service.answer(q)) for q in QUESTIONS[:5]]
+            await asyncio.sleep(0.2)
+            # one request is in the blocked batch, two are queued and two wait for a slot
+            assert service.queue.full()
+            assert not any(task.done() for task in tasks)
+            llm.gate.set()
+            return await asyncio.gather(*tasks)
+        finally:
+            llm.gate.set()
+            await service.stop()
+
+    llm = GatedLLM()
+    llm.gate.clear()
+    records = run(main())
+    assert [r["question"] for r in records] == QUESTIONS[:5]
+
+
+def test_failing_question_only_fails_its_request(poly):
+    async def main():
+        service = PolyRAGService(poly, llm, max_batch_size=4, max_wait_ms=50)
+        await service.start()
+        try:
+            questions = QUESTIONS[:3] + ["boom"]
+            return await asyncio.gather(*(service.answer(q) for q in questions), return_exceptions=True), service.stats
+        finally:
+            await service.stop()
+
+    llm = GatedLLM()
+    results, stats = run(main())
+    assert [r["question"] for r in results[:3]] == QUESTIONS[:3]
+    assert isinstance(results[3], ValueError)
+    assert stats["errors"] == 1
+
+
+def test_stop_fails_pending_requests(poly):
+    async def main():
+        service = PolyRAGService(poly, llm, max_batch_size=1, max_wait_ms=0)
+        await service.start()
+        tasks = [asyncio.create_task(service.answer(q)) for q in QUESTIONS[:3]]
+        await asyncio.sleep(0.2)
+        # the first request is in flight, the others are queued; the blocked batch is released after stop
+        threading.Timer(0.2, llm.gate.set).start()
+        await service.stop()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    llm = GatedLLM()
+    llm.gate.clear()
+    results = run(main())
+    assert all(isinstance(r, RuntimeError) and "stopped" in str(r) for r in results)